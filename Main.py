@@ -2,143 +2,721 @@ import pandas as pd
 import numpy as np
 
 import xgboost as xgb
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold
 from sklearn.utils import resample
+from joblib import parallel_backend
+from threadpoolctl import threadpool_limits
 
 from skopt import BayesSearchCV
 
-from scipy.stats import mannwhitneyu
+from scipy import sparse
+from scipy.stats import mannwhitneyu, rankdata
+from scipy.special import ndtr
 from statsmodels.stats import multitest
 
 import sys
 import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 sys.path.append(os.getcwd())
 
-# import PyRauLCF
-
-
-# def RauLCF(data, cond_col):
-#     '''
-#     Function that applies Rau low counts filtering.
-#     Requirements:
-#     - PyRauLCF.py script and neccessary support files
-#
-#     Arguments:
-#     - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
-#     - cond_col: a name of the condition column
-#
-#     Returns:
-#     - A dataframe with excluded genes with expression lower than threshold for every sample
-#     '''
-#     matrix = data.drop(columns=[cond_col]).to_numpy(dtype='float32')
-#     vector = data[cond_col].apply(lambda x: str(x)).to_list()
-#
-#     # Running filter
-#     threshold = PyRauLCF.FindOptimalThreshold(matrix, vector, 1, 200, 25)
-#
-#     print("The threshould from RauLCF is " + str(threshold))
-#
-#     # Removing all genes below threshold
-#     filtered_data = data.loc[:, (data.max(axis=0) > threshold)]
-#
-#     filtered_data[cond_col] = data[cond_col]
-#
-#     print("Number of removed genes: " + str(len(data.columns) - len(filtered_data.columns)))
-#
-#     return filtered_data
-
-
-def get_features_stability(data, clf, cond_col, rand_state):
+import artifacts
+import checkpoints
+import elastic_net
+import matrix_io
+import param_cache
+import progress
+import PyRauLCF
+
+# In the low-memory mode, a matrix with at least this fraction of zeros is kept as sparse CSR
+SPARSE_MIN_ZEROS = 0.6
+
+
+def RauLCF(data, cond_col):
     '''
-    Function that runs model on the stratified random subsamples, retrieving the feature importances.
+    Function that applies Rau low counts filtering.
+    Requirements:
+    - PyRauLCF.py script
+
     Arguments:
     - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
-    - clf: a model
     - cond_col: a name of the condition column
-    - rand_state: random state
 
     Returns:
-    - A dataframe with genes importances
+    - A dataframe with excluded genes with expression lower than threshold for every sample
     '''
-    sample = resample(data, n_samples=int(data.shape[0] * 0.8), stratify=data[cond_col], random_state=rand_state)
+    expr = data.drop(columns=[cond_col])
+    matrix = expr.to_numpy(dtype='float32')
+    vector = data[cond_col].apply(lambda x: str(x)).to_list()
 
-    clf = clf.fit(sample.drop(columns=[cond_col]), sample[cond_col].astype('int'))
+    # Running filter
+    threshold = PyRauLCF.FindOptimalThreshold(matrix, vector, 1, 200, 25)
 
-    feature_importance = pd.DataFrame(clf.feature_importances_, sample.drop(columns=cond_col).columns)
-    feature_importance.rename(columns={0: "Importance"}, inplace=True)
+    print("The threshould from RauLCF is " + str(threshold))
 
-    return (feature_importance)
+    # Removing all genes below threshold
+    keep = expr.columns[matrix.max(axis=0) > threshold].tolist()
+    filtered_data = data[keep + [cond_col]]
 
+    print("Number of removed genes: " + str(expr.shape[1] - len(keep)))
 
-def run_xgb(data, cond_col, top_importance, n_obs, n_iter):
+    return filtered_data
+
+
+def expression_matrix(data, cond_col, low_memory=False):
     '''
-    Function that optimizes the hyperparameters for XGB using Bayesian search, then running on a
-    subsamples and providing a feature importances.
-    Requirements:
-    - get_features_stability() function
+    Function that converts a dataframe into the model input.
+    A dataframe with a single float32 block of genes (e.g. read by matrix_io) is converted without a copy.
+    In the low-memory mode a matrix with mostly zero counts is converted into sparse CSR;
+    XGBoost treats zeros absent from a sparse matrix as missing values.
 
     Arguments:
     - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
     - cond_col: a name of the condition column
+    - low_memory: whether a mostly zero matrix may be converted into sparse CSR
+
+    Returns:
+    - A tuple (gene names, float32 (samples, genes) array or CSR matrix, integer array with conditions)
+    '''
+    expr = data.drop(columns=[cond_col])
+    matrix = expr.to_numpy(dtype='float32', na_value=np.nan)
+    if low_memory and matrix.size and 1 - np.count_nonzero(matrix) / matrix.size >= SPARSE_MIN_ZEROS:
+        matrix = sparse.csr_matrix(matrix)
+
+    return expr.columns, matrix, data[cond_col].to_numpy(dtype='int64')
+
+
+def split_thread_budget(n_threads=None, search_cv=2):
+    '''
+    Function that splits the thread budget of one job between the pipeline stages, so that
+    several jobs on one host do not oversubscribe the CPU.
+
+    Arguments:
+    - n_threads: number of threads the job may use, all cores by default
+    - search_cv: number of cross-validation folds in the hyperparameters search
+
+    Returns:
+    - A dict with the number of parallel fits in the search ('search_jobs'), XGBoost and BLAS threads
+      per search fit ('xgb_threads') and single-threaded processes for stability selection ('stability_jobs')
+    '''
+    n_threads = max(int(n_threads or os.cpu_count()), 1)
+    # BayesSearchCV evaluates one candidate at a time, so only the folds can run in parallel
+    search_jobs = min(n_threads, search_cv)
+
+    return {'search_jobs': search_jobs,
+            'xgb_threads': max(n_threads // search_jobs, 1),
+            'stability_jobs': n_threads}
+
+
+# Read-only state of a stability selection worker process, filled by _init_stability_worker()
+_stability_state = {}
+
+
+def _share_arrays(arrays):
+    '''
+    Copies arrays into shared memory blocks, returns the blocks and (name, shape, dtype) specs to attach them.
+    '''
+    blocks, specs = [], []
+    try:
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            blocks.append(shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=blocks[-1].buf)[:] = array
+            specs.append((blocks[-1].name, array.shape, array.dtype.str))
+    except BaseException:
+        _release_arrays(blocks)
+        raise
+    return blocks, specs
+
+
+def _release_arrays(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def _init_stability_worker(specs, sparse_shape, labels, clf):
+    '''
+    Process pool initializer: attaches the expression matrix from shared memory without copying it.
+    A sparse matrix is shared as its data, indices and indptr arrays.
+    '''
+    threadpool_limits(limits=1, user_api='blas')
+    blocks, arrays = [], []
+    for name, shape, dtype in specs:
+        blocks.append(shared_memory.SharedMemory(name=name))
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf))
+        arrays[-1].flags.writeable = False
+
+    matrix = sparse.csr_matrix(tuple(arrays), shape=sparse_shape) if sparse_shape else arrays[0]
+    _stability_state.update(blocks=blocks, matrix=matrix, labels=labels, clf=clf,
+                            dtrain=stability_dmatrix(matrix, labels, clf))
+
+
+def _run_stability_iteration(rand_state):
+    return get_features_stability(_stability_state['matrix'], _stability_state['labels'],
+                                  _stability_state['clf'], rand_state, _stability_state['dtrain'])
+
+
+def stability_dmatrix(matrix, labels, clf):
+    '''
+    Function that builds the XGBoost matrix of all samples, shared by all stability iterations.
+    Tree boosters get a QuantileDMatrix: histogram bin edges are computed once and reused for the subsamples.
+    gblinear can't train on binned features and gets a plain DMatrix, subsamples are its row slices.
+
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - clf: a model
+
+    Returns:
+    - A DMatrix, or None if clf is not an XGBoost model
+    '''
+    if not isinstance(clf, xgb.XGBModel):
+        return None
+    if clf.booster == 'gblinear':
+        return xgb.DMatrix(matrix, label=labels, missing=clf.missing, nthread=clf.n_jobs)
+    return xgb.QuantileDMatrix(matrix, label=labels, missing=clf.missing, nthread=clf.n_jobs,
+                               max_bin=clf.max_bin)
+
+
+def _subsample_dmatrix(dtrain, matrix, labels, rows, weights):
+    '''
+    Builds an XGBoost matrix of a subsample from the matrix of all samples made by stability_dmatrix().
+    '''
+    if isinstance(dtrain, xgb.QuantileDMatrix):
+        return xgb.QuantileDMatrix(matrix[rows], label=labels[rows], weight=weights, ref=dtrain,
+                                   missing=dtrain.missing, nthread=dtrain.nthread, max_bin=dtrain.max_bin)
+    dsample = dtrain.slice(rows)
+    dsample.set_weight(weights)
+    return dsample
+
+
+def _xgb_importances(clf, dtrain, n_classes):
+    '''
+    Trains a booster with the parameters of an XGBClassifier and returns its feature_importances_.
+    '''
+    params = clf.get_xgb_params()
+    if n_classes > 2:  # same as XGBClassifier.fit()
+        if params.get('objective') != 'multi:softmax':
+            params['objective'] = 'multi:softprob'
+        params['num_class'] = n_classes
+    booster = xgb.train(params, dtrain, clf.get_num_boosting_rounds())
+
+    importance_type = clf.importance_type or ('weight' if clf.booster == 'gblinear' else 'gain')
+    score = booster.get_score(importance_type=importance_type)
+    importances = np.array([score.get(f'f{i}', 0.) for i in range(dtrain.num_col())], dtype='float32')
+    total = importances.sum()
+    return importances / total if total else importances
+
+
+def get_features_stability(matrix, labels, clf, rand_state, dtrain=None):
+    '''
+    Function that runs model on the stratified random subsamples, retrieving the feature importances.
+    Subsample is taken by row indices, so the matrix itself is never copied as a whole.
+    With dtrain (see stability_dmatrix()) an XGBoost model is trained on the distinct rows of the subsample,
+    weighted by the number of times they were drawn, and features are binned by the bin edges of dtrain.
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - clf: a model
+    - rand_state: random state
+    - dtrain: an XGBoost matrix built by stability_dmatrix(), None to fit clf on the subsample
+
+    Returns:
+    - An array with genes importances
+    '''
+    sample = resample(np.arange(len(labels)), n_samples=int(len(labels) * 0.8), stratify=labels,
+                      random_state=rand_state)
+
+    if dtrain is not None:
+        # Resampling is with replacement, a row drawn k times has weight k
+        counts = np.bincount(sample, minlength=len(labels))
+        rows = np.flatnonzero(counts)
+        dsample = _subsample_dmatrix(dtrain, matrix, labels, rows, counts[rows].astype('float32'))
+        importances = _xgb_importances(clf, dsample, len(np.unique(labels)))
+    else:
+        importances = clone(clf).fit(matrix[sample], labels[sample]).feature_importances_
+
+    # gblinear gives a (genes, classes) array of coefficients for multiclass objectives
+    importances = np.abs(importances)
+    return importances.sum(axis=1) if importances.ndim == 2 else importances
+
+
+def collect_importances(matrix, labels, clf, n_iter, n_jobs=None, checkpoint_dir=None, checkpoint_name='importance'):
+    '''
+    Function that runs get_features_stability() for every random state from 0 to n_iter - 1 in a process pool.
+    The matrix (or the arrays of a CSR matrix) is placed into shared memory once and read by all the workers,
+    every worker converts it into an XGBoost matrix once for all its iterations.
+    Every finished iteration is checkpointed, iterations found in checkpoint_dir are not run again.
+    Requirements:
+    - get_features_stability() function
+    - stability_dmatrix() function
+    - checkpoints module
+
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - clf: a model
+    - n_iter: number of random subsamples
+    - n_jobs: number of worker processes, all cores by default
+    - checkpoint_dir: checkpoint directory of the job, no checkpoints by default
+    - checkpoint_name: checkpoint name prefix, iteration i is saved as '{checkpoint_name}_{i}'
+
+    Returns:
+    - A (genes, n_iter) array with genes importances for every iteration
+    '''
+    importances = np.empty((matrix.shape[1], n_iter), dtype='float64')
+    todo = []
+    for i in range(n_iter):
+        checkpoint = checkpoints.load(checkpoint_dir, f'{checkpoint_name}_{i}')
+        if checkpoint is None:
+            todo.append(i)
+        else:
+            importances[:, i] = checkpoint['importance']
+
+    n_jobs = min(n_jobs or os.cpu_count(), len(todo))
+    started = time.monotonic()
+
+    if n_jobs <= 1:
+        dtrain = stability_dmatrix(matrix, labels, clf)
+        for done, i in enumerate(todo, 1):
+            importances[:, i] = get_features_stability(matrix, labels, clf, i, dtrain)
+            checkpoints.save(checkpoint_dir, f'{checkpoint_name}_{i}', importance=importances[:, i])
+            progress.report_fits(done, len(todo), started)
+        return importances
+
+    # Each process fits its own model, one thread per model avoids oversubscription
+    if 'n_jobs' in clf.get_params():
+        clf = clone(clf).set_params(n_jobs=1)
+
+    if sparse.issparse(matrix):
+        matrix = matrix.tocsr()
+        blocks, specs = _share_arrays((matrix.data, matrix.indices, matrix.indptr))
+        sparse_shape = matrix.shape
+    else:
+        blocks, specs = _share_arrays((matrix,))
+        sparse_shape = None
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_stability_worker,
+                                 initargs=(specs, sparse_shape, labels, clf)) as pool:
+            futures = {pool.submit(_run_stability_iteration, i): i for i in todo}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                importances[:, i] = future.result()
+                checkpoints.save(checkpoint_dir, f'{checkpoint_name}_{i}', importance=importances[:, i])
+                progress.report_fits(done, len(todo), started)
+    finally:
+        _release_arrays(blocks)
+
+    return importances
+
+
+def stability_counts(importances, top_importance):
+    '''
+    Function that counts how many times every gene gets into the top list of importances.
+
+    Arguments:
+    - importances: a (genes, iterations) array with genes importances
     - top_importance: the number of most important genes to keep from each iteration
+
+    Returns:
+    - An array with the number of iterations for every gene
+    '''
+    n_genes, n_iter = importances.shape
+    in_top = np.zeros((n_genes, n_iter), dtype=bool)
+    for i in range(n_iter):
+        # pandas sort is used to pick the same genes among equal importances as before
+        order = pd.Series(importances[:, i]).sort_values(ascending=False).index[:top_importance]
+        in_top[order, i] = True
+
+    return in_top.sum(axis=1)
+
+
+def select_stable_genes(counts, n_iter, n_obs):
+    '''
+    Function that keeps the genes which often get into the top list of importances.
+
+    Arguments:
+    - counts: number of iterations in the top list for every gene, from stability_counts()
+      (or an average of them over several models)
+    - n_iter: number of iterations
     - n_obs: required minimal number of occurrences of a gene in the top list across all iterations
+
+    Returns:
+    - A boolean mask of stable genes
+    '''
+    n_missing = n_iter - counts
+
+    return (counts > 0) & (n_missing <= n_obs * n_iter)
+
+
+def _sample_param(dimension, rng):
+    '''
+    Draws a value from a search space dimension, read the same way as in skopt:
+    a pair of ints or floats is a uniform range, a tuple of strings is a categorical choice.
+    '''
+    if all(isinstance(v, str) for v in dimension):
+        return dimension[rng.integers(len(dimension))]
+    low, high = dimension
+    if isinstance(low, int) and isinstance(high, int):
+        return int(rng.integers(low, high, endpoint=True))
+    return float(rng.uniform(low, high))
+
+
+def halving_search_xgb(matrix, labels, search_space, cv=2, n_candidates=50, eta=3, min_rounds=5, max_rounds=500,
+                       early_stopping_rounds=10, time_budget=None, max_evals=None, n_threads=None, random_state=500):
+    '''
+    Function that searches the hyperparameters for XGB using successive halving: all candidates are trained
+    for a few boosting rounds, only the best 1/eta of them get eta times more rounds, and so on up to max_rounds.
+    Each fit stops early when the held-out error stops improving, and the number of trees is taken from there.
+    Requirements:
+    - _sample_param() function
+
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - search_space: a dict with the search space in BayesSearchCV format, n_estimators is found by early stopping
+    - cv: number of cross-validation folds
+    - n_candidates: number of random candidates in the first round
+    - eta: the halving factor
+    - min_rounds: number of boosting rounds in the first round
+    - max_rounds: maximal number of boosting rounds
+    - early_stopping_rounds: number of rounds without improvement on a held-out fold to stop training
+    - time_budget: wall-clock limit of the search in seconds, no limit by default
+    - max_evals: limit on the number of fits (candidate x fold), no limit by default
+    - n_threads: number of XGBoost threads, all cores by default
+    - random_state: random state
+
+    Returns:
+    - A dict with the best hyperparameters, same keys as search_space
+    '''
+    start = time.monotonic()
+    n_evals = 0
+    rng = np.random.default_rng(random_state)
+    n_threads = split_thread_budget(n_threads, search_cv=1)['xgb_threads']
+
+    params = {'objective': 'multi:softmax', 'num_class': len(np.unique(labels)), 'eval_metric': 'merror',
+              'nthread': n_threads, 'seed': random_state}
+
+    # Folds are quantized once and reused by all candidates
+    folds = [(xgb.DMatrix(matrix[train], label=labels[train], nthread=n_threads),
+              xgb.DMatrix(matrix[valid], label=labels[valid], nthread=n_threads))
+             for train, valid in StratifiedKFold(cv, shuffle=True, random_state=random_state).split(matrix, labels)]
+
+    candidates = [{name: _sample_param(dimension, rng) for name, dimension in search_space.items()
+                   if name != 'n_estimators'} for _ in range(n_candidates)]
+
+    n_rungs = max(int(np.log(max_rounds / min_rounds) // np.log(eta)), 0)
+    best = None
+    for rung in range(n_rungs + 1):
+        rounds = int(round(max_rounds * eta ** (rung - n_rungs)))
+
+        scores = []
+        for candidate in candidates:
+            if best is not None and ((time_budget and time.monotonic() - start > time_budget) or
+                                     (max_evals and n_evals >= max_evals)):
+                break
+
+            errors, n_trees = [], []
+            for dtrain, dvalid in folds:
+                booster = xgb.train({**params, **candidate}, dtrain, num_boost_round=rounds,
+                                    evals=[(dvalid, 'valid')], early_stopping_rounds=early_stopping_rounds,
+                                    verbose_eval=False)
+                errors.append(booster.best_score)
+                n_trees.append(booster.best_iteration + 1)
+                n_evals += 1
+            scores.append((float(np.mean(errors)), int(np.mean(n_trees)), candidate))
+
+            if best is None:
+                best = scores[-1]
+
+        if not scores:  # budget is over
+            break
+
+        # Candidates are kept sorted, so a partially evaluated round still has the leaders of the previous one
+        scores.sort(key=lambda score: score[:2])
+        best = scores[0]
+        candidates = [candidate for error, n_trees, candidate in scores[:max(len(scores) // eta, 1)]]
+
+    error, n_trees, candidate = best
+    print(f'Halving search: {n_evals} fits in {time.monotonic() - start:.1f} s, held-out error {error:.4f}')
+
+    # The number of trees is kept within the search space
+    low, high = search_space.get('n_estimators', (min_rounds, max_rounds))
+    return {**candidate, 'n_estimators': int(np.clip(n_trees, low, high))}
+
+
+def xgb_importances(matrix, labels, genes, n_iter, n_threads=None, search='bayes', search_time_budget=None,
+                    search_max_evals=None, cache_dir=None, cache_size=None, checkpoint_dir=None, samples=None):
+    '''
+    Function that optimizes the hyperparameters for XGB using Bayesian search, then running on a
+    subsamples and providing a feature importances.
+    Best hyperparameters and importances are cached by dataset content, so only top_importance and n_obs
+    are applied again when the same data is submitted with other thresholds.
+    With samples, the search is skipped when the cache has a run on a subset of the samples of the same input
+    (a resubmission with appended samples), and the hyperparameters of that run are used.
+    Requirements:
+    - param_cache module
+    - split_thread_budget() function
+    - halving_search_xgb() function
+    - collect_importances() function
+
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - genes: gene names, in the order of matrix columns
     - n_iter: number of random subsamples
+    - n_threads: number of threads the job may use, all cores by default
+    - search: hyperparameters search mode, 'bayes' (BayesSearchCV) or 'halving' (successive halving
+      with early stopping)
+    - search_time_budget: wall-clock limit of the 'halving' search in seconds
+    - search_max_evals: limit on the number of fits in the 'halving' search
+    - cache_dir: directory for cached search results, no caching by default
+    - cache_size: cache size limit in bytes
+    - checkpoint_dir: checkpoint directory of the job, no checkpoints by default
+    - samples: a tuple (gene names, hashes from param_cache.sample_hashes()) of the input before filtering,
+      enables the reuse of hyperparameters for appended samples
 
     Returns:
-    - A dataframe with important genes
+    - A (genes, n_iter) array with genes importances for every iteration
     '''
-    XGBclf = BayesSearchCV(
-        xgb.XGBClassifier(objective="multi:softmax",
-                          num_class=str(len(np.unique(data[cond_col]))),
-                          random_state=500),
-        {
-            'n_estimators': (5, 500),
-            'learning_rate': (0.0001, 0.9),
-            'booster': ("gbtree", "gblinear", "dart"),
-            'reg_alpha': (0.0001, 1)
-        },
-        cv=2,
-        n_jobs=24,
-        random_state=500
-    )
-    XGBclf.fit(data.drop(columns=[cond_col]), data[cond_col].astype('int_'))
-    best_params_xgb = XGBclf.best_params_
+    budget = split_thread_budget(n_threads, search_cv=2)
+
+    search_space = {
+        'n_estimators': (5, 500),
+        'learning_rate': (0.0001, 0.9),
+        'booster': ("gbtree", "gblinear", "dart"),
+        'reg_alpha': (0.0001, 1)
+    }
+
+    settings = {'search': search, 'search_space': search_space, 'search_time_budget': search_time_budget,
+                'search_max_evals': search_max_evals}
+    cache_key = param_cache.dataset_fingerprint(matrix, labels, genes, settings) if cache_dir else None
+    cached = param_cache.load(cache_dir, cache_key) if cache_dir else None
+    checkpoint = checkpoints.load(checkpoint_dir, 'search')
+    if cache_dir and samples is not None:
+        samples = (param_cache.dataset_key(samples[0], settings), samples[1])
+        base = None if cached or checkpoint else param_cache.find_base(cache_dir, *samples)
+    else:
+        samples = base = None
+
+    if cached:
+        best_params_xgb, importances = cached
+        print('Loaded search results from cache')
+    elif checkpoint:
+        importances = None
+        best_params_xgb = json.loads(str(checkpoint['params']))
+        print('Loaded search results from checkpoint')
+    elif base:
+        importances = None
+        best_params_xgb = base
+        print('Loaded search results of a previous run on a subset of the samples')
+    elif search == 'halving':
+        importances = None
+        with progress.stage('search', matrix.shape):
+            best_params_xgb = halving_search_xgb(matrix, labels, search_space, cv=2, time_budget=search_time_budget,
+                                                 max_evals=search_max_evals, n_threads=n_threads)
+    else:
+        importances = None
+        XGBclf = BayesSearchCV(
+            xgb.XGBClassifier(objective="multi:softmax",
+                              num_class=str(len(np.unique(labels))),
+                              n_jobs=budget['xgb_threads'],
+                              random_state=500),
+            search_space,
+            cv=2,
+            n_jobs=budget['search_jobs'],
+            random_state=500
+        )
+        # Limits OpenMP and BLAS threads inside joblib workers
+        with progress.stage('search', matrix.shape), \
+                parallel_backend('loky', inner_max_num_threads=budget['xgb_threads']):
+            XGBclf.fit(matrix, labels)
+        best_params_xgb = XGBclf.best_params_
+
+    if not cached and not checkpoint:
+        best_params_xgb = {name: value.item() if isinstance(value, np.generic) else value
+                           for name, value in best_params_xgb.items()}
+        checkpoints.save(checkpoint_dir, 'search', params=json.dumps(best_params_xgb))
 
     print(best_params_xgb)
 
-    XGBclf_best = xgb.XGBClassifier(n_estimators=best_params_xgb['n_estimators'],
-                                    max_depth=best_params_xgb['max_depth'],
-                                    max_leaves=best_params_xgb['max_leaves'],
-                                    learning_rate=best_params_xgb['learning_rate'],
-                                    booster=best_params_xgb['booster'],
-                                    reg_alpha=best_params_xgb['reg_alpha'],
+    XGBclf_best = xgb.XGBClassifier(**best_params_xgb,
                                     objective="multi:softmax",
-                                    num_class=str(len(np.unique(data[cond_col]))),
+                                    num_class=str(len(np.unique(labels))),
+                                    n_jobs=budget['xgb_threads'],
                                     random_state=500)
 
-    # Obtaining feature importance for different data subsets
-    for i in range(n_iter):
-        importance = get_features_stability(data, XGBclf_best, cond_col, i).abs().mean(axis=1).sort_values(
-            ascending=False)
-        if i == 0:
-            stability_xgb = importance.iloc[:top_importance]
-        else:
-            stability_xgb = pd.concat([stability_xgb, importance.iloc[:top_importance]], axis=1)
+    # Obtaining feature importance for different data subsets; iterations are seeded 0..n_iter - 1,
+    # so cached importances from at least as many iterations can be reused
+    if importances is not None and importances.shape[1] >= n_iter:
+        return importances[:, :n_iter]
+
+    with progress.stage('stability', matrix.shape):
+        importances = collect_importances(matrix, labels, XGBclf_best, n_iter, n_jobs=budget['stability_jobs'],
+                                          checkpoint_dir=checkpoint_dir)
+    if cache_dir:
+        param_cache.save(cache_dir, cache_key, best_params_xgb, importances, max_size=cache_size, samples=samples)
+
+    return importances
+
+
+def enet_importances(matrix, labels, n_iter, l1_ratio=0.5, n_threads=None, checkpoint_dir=None, genes=None,
+                     cache_dir=None, cache_size=None):
+    '''
+    Function that fits elastic-net logistic regression paths on the same random subsamples as XGB
+    and provides a feature importances.
+    Importances are cached by dataset content and model settings, as in xgb_importances().
+    Requirements:
+    - elastic_net module
+    - param_cache module
+    - collect_importances() function
+
+    Arguments:
+    - matrix: a (samples, genes) array or CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - n_iter: number of random subsamples
+    - l1_ratio: elastic-net mixing parameter, 1 is lasso
+    - n_threads: number of threads the job may use, all cores by default
+    - checkpoint_dir: checkpoint directory of the job, no checkpoints by default
+    - genes: gene names, in the order of matrix columns, needed for caching
+    - cache_dir: directory for cached importances, no caching by default
+    - cache_size: cache size limit in bytes
+
+    Returns:
+    - A (genes, n_iter) array with genes importances for every iteration
+    '''
+    clf = elastic_net.ElasticNetPath(l1_ratio=l1_ratio, random_state=500)
+    n_jobs = split_thread_budget(n_threads)['stability_jobs']
+
+    settings = {'model': 'enet', **clf.get_params()}
+    cache_key = param_cache.dataset_fingerprint(matrix, labels, genes, settings) if cache_dir else None
+    cached = param_cache.load(cache_dir, cache_key) if cache_dir else None
+    # Iterations are seeded 0..n_iter - 1, so cached importances from at least as many iterations can be reused
+    if cached and cached[1] is not None and cached[1].shape[1] >= n_iter:
+        print('Loaded elastic-net importances from cache')
+        return cached[1][:, :n_iter]
+
+    with progress.stage('enet', matrix.shape):
+        importances = collect_importances(matrix, labels, clf, n_iter, n_jobs=n_jobs, checkpoint_dir=checkpoint_dir,
+                                          checkpoint_name='enet_importance')
+    if cache_dir:
+        param_cache.save(cache_dir, cache_key, settings, importances, max_size=cache_size)
+
+    return importances
+
+
+def run_models(data, cond_col, top_importance, n_obs, n_iter, models=('xgb',), n_threads=None, search='bayes',
+               search_time_budget=None, search_max_evals=None, cache_dir=None, cache_size=None, checkpoint_dir=None,
+               low_memory=False, enet_l1_ratio=0.5, samples=None):
+    '''
+    Function that runs stability selection with the models: genes are counted in the top lists of importances
+    of every model, and the counts are averaged over the models, so a gene is kept when it's stable in the models
+    on average.
+    Requirements:
+    - expression_matrix() function
+    - xgb_importances() function
+    - enet_importances() function
+    - stability_counts() function
+    - select_stable_genes() function
+
+    Arguments:
+    - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
+    - cond_col: a name of the condition column
+    - top_importance: the number of most important genes to keep from each iteration
+    - n_obs: required minimal number of occurrences of a gene in the top list across all iterations
+    - n_iter: number of random subsamples
+    - models: models for stability selection, 'xgb' (XGBoost) and/or 'enet' (elastic-net logistic regression)
+    - n_threads: number of threads the job may use, all cores by default
+    - search: XGB hyperparameters search mode, 'bayes' (BayesSearchCV) or 'halving' (successive halving
+      with early stopping)
+    - search_time_budget: wall-clock limit of the 'halving' search in seconds
+    - search_max_evals: limit on the number of fits in the 'halving' search
+    - cache_dir: directory for cached XGB search results, no caching by default
+    - cache_size: cache size limit in bytes
+    - checkpoint_dir: checkpoint directory of the job, no checkpoints by default
+    - low_memory: whether a mostly zero matrix is passed to the models as sparse CSR
+    - enet_l1_ratio: elastic-net mixing parameter, 1 is lasso
+    - samples: a tuple (gene names, sample hashes) of the input before filtering, see xgb_importances()
 
-    stability_xgb['genes'] = stability_xgb.index
+    Returns:
+    - A dataframe with important genes
+    '''
+    unknown = set(models) - {'xgb', 'enet'}
+    if not models or unknown:
+        raise ValueError(f'Unknown models: {sorted(unknown)}' if unknown else 'No models for stability selection')
+
+    genes, matrix, labels = expression_matrix(data, cond_col, low_memory)
 
-    stable_genes = stability_xgb.loc[stability_xgb.isna().sum(axis=1) <= n_obs * n_iter, 'genes']
+    counts = []
+    if 'xgb' in models:
+        importances = xgb_importances(matrix, labels, genes, n_iter, n_threads, search, search_time_budget,
+                                      search_max_evals, cache_dir, cache_size, checkpoint_dir, samples)
+        counts.append(stability_counts(importances, top_importance))
+    if 'enet' in models:
+        importances = enet_importances(matrix, labels, n_iter, enet_l1_ratio, n_threads, checkpoint_dir, genes,
+                                       cache_dir, cache_size)
+        counts.append(stability_counts(importances, top_importance))
 
-    ml_filtered_data = data[stable_genes.values.tolist()]
+    stable_genes = genes[select_stable_genes(np.mean(counts, axis=0), n_iter, n_obs)]
+
+    ml_filtered_data = data[stable_genes.tolist()]
     ml_filtered_data[cond_col] = data[cond_col]
 
     return ml_filtered_data
 
 
+def mannwhitneyu_batch(x, y):
+    '''
+    Function that runs two-sided Mann-Whitney U tests for all genes at once.
+    Both groups are ranked together in a single call, ties are corrected as in scipy.
+    Genes that scipy would test with the exact method (small groups without ties) and genes with NaNs
+    are passed to scipy's mannwhitneyu in one call each, so p-values are the same as in the per-gene loop.
+
+    Arguments:
+    - x: a (samples, genes) float array with expressions of the first group
+    - y: a (samples, genes) float array with expressions of the second group
+
+    Returns:
+    - An array with p-values for every gene
+    '''
+    n1, n2 = x.shape[0], y.shape[0]
+    n = n1 + n2
+    xy = np.concatenate([x, y], axis=0)
+
+    ranks = rankdata(xy, axis=0)
+    # Every value in a tie group of size t contributes t^2 - 1, so the sum over values is sum(t^3 - t) over groups
+    ties = rankdata(xy, method='max', axis=0) - rankdata(xy, method='min', axis=0) + 1
+    tie_term = (ties ** 2 - 1).sum(axis=0)
+
+    u1 = ranks[:n1].sum(axis=0) - n1 * (n1 + 1) / 2
+    u = np.maximum(u1, n1 * n2 - u1)
+
+    s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (u - n1 * n2 / 2 - 0.5) / s
+    pvals = np.clip(2 * ndtr(-z), 0., 1.)
+
+    has_nan = np.isnan(xy).any(axis=0)
+    exact = ~has_nan & (tie_term == 0) if not (n1 > 8 and n2 > 8) else np.zeros_like(has_nan)
+    if exact.any():  # all exact genes in one call, the null distribution is shared
+        pvals[exact] = mannwhitneyu(x[:, exact], y[:, exact], axis=0, method='exact').pvalue
+    if has_nan.any():
+        pvals[has_nan] = mannwhitneyu(x[:, has_nan], y[:, has_nan], axis=0, nan_policy='omit').pvalue
+
+    return pvals
+
+
 def run_utest(data, cond_col):
     '''
     Function that runs multiple Mann-Whitney U tests for every pair of conditions.
     FDR is controlled using Benjamini-Hochberg correction.
+    Requirements:
+    - mannwhitneyu_batch() function
 
     Arguments:
     - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
@@ -149,24 +727,22 @@ def run_utest(data, cond_col):
     '''
     groups = np.unique(data[cond_col])
 
-    results_df = []
     expr = data.drop(columns=[cond_col])
-
-    # Loop over each feature
-    for i in range(expr.shape[1]):
-        # Loop over each possible pair of groups
-        for j in range(len(groups)):
-            for k in range(j + 1, len(groups)):
-                # Get the samples for each group
-                group1 = expr.loc[(data[cond_col] == groups[j]), expr.columns[i]].apply(lambda x: float(x))
-                group2 = expr.loc[(data[cond_col] == groups[k]), expr.columns[i]].apply(lambda x: float(x))
-                # Run the Mann-Whitney U test and print the result
-                stat, pval = mannwhitneyu(group1, group2, nan_policy='omit')
-                results_df.append({'Gene': expr.columns[i],
-                                   'Groups': f'Group {groups[j] + 1} vs Group {groups[k] + 1}',
-                                   'pval': pval})
-
-    results_df = pd.DataFrame.from_records(results_df)
+    genes = expr.columns.to_numpy()
+    matrix = expr.to_numpy(dtype='float64', na_value=np.nan)
+    cond = data[cond_col].to_numpy()
+
+    # Test all genes for each possible pair of groups
+    pairs, pvals = [], []
+    for j in range(len(groups)):
+        for k in range(j + 1, len(groups)):
+            pairs.append(f'Group {groups[j] + 1} vs Group {groups[k] + 1}')
+            pvals.append(mannwhitneyu_batch(matrix[cond == groups[j]], matrix[cond == groups[k]]))
+
+    # Same row order as a loop over genes, then over pairs of groups
+    results_df = pd.DataFrame({'Gene': np.repeat(genes, len(pairs)),
+                               'Groups': np.tile(pairs, len(genes)),
+                               'pval': np.column_stack(pvals).ravel() if pairs else []})
 
     rej, p_adj, alphsid, alphb = multitest.multipletests(results_df['pval'], alpha=0.05, method='fdr_bh')
 
@@ -175,43 +751,108 @@ def run_utest(data, cond_col):
     return results_df.sort_values(by=['padj'])
 
 
-def MarkerFinder(data, cond_col, top_importance, n_obs, n_iter, output_stat, output_hm):
+def MarkerFinder(data, cond_col, top_importance, n_obs, n_iter, output_stat, output_hm, n_threads=None,
+                 search='bayes', search_time_budget=None, search_max_evals=None, cache_dir=None, cache_size=None,
+                 checkpoint_dir=None, low_memory=False, models=('xgb',), enet_l1_ratio=0.5, incremental=False,
+                 compress_results=False):
     '''
     Function that runs all the functions above. The order:
     1) Rau filter
     2) XGBoost
         2a) Hyperparameters tuning
         2b) Retrieveing importances
-    3) Mann-Whitney
+    3) Elastic-net logistic regression, if it's in models
+    4) Mann-Whitney
 
     Arguments:
-    - data: a dataframe with counts/pseudocounts of genes expressions and a condition column
+    - data: a binary matrix file (see matrix_io) or a tab-separated file with counts/pseudocounts
+      of genes expressions and a condition column
     - cond_col: a name of the condition column
     - top_importance: the number of most important genes to keep from each iteration
     - n_obs: required minimal number of occurrences of a gene in the top list across all iterations
     - n_iter: number of random subsamples
     - output_stat: file name for the results output
     - output_hm: file name for the heatmap dataset output
+    - n_threads: number of threads the job may use, all cores by default
+    - search: hyperparameters search mode, 'bayes' or 'halving'
+    - search_time_budget: wall-clock limit of the 'halving' search in seconds
+    - search_max_evals: limit on the number of fits in the 'halving' search
+    - cache_dir: directory for cached search results, no caching by default
+    - cache_size: cache size limit in bytes
+    - checkpoint_dir: directory for checkpoints of the stages, a retried job resumes from them;
+      removed when the job is finished
+    - low_memory: whether to keep genes of a text input as float32 instead of nullable dtypes, and pass
+      a mostly zero matrix to the models as sparse CSR
+    - models: models for stability selection, 'xgb' and/or 'enet'
+    - enet_l1_ratio: elastic-net mixing parameter, 1 is lasso
+    - incremental: whether to start from the hyperparameters of a previous run when the input is
+      a previously analyzed dataset with appended samples, requires cache_dir
+    - compress_results: whether to replace output_stat and output_hm with gzip-compressed copies
+      (output_stat.gz, output_hm.gz) kept in the artifact store
 
     Returns:
     - A dataframe with genes, groups tested, pvals and padj
     '''
-    raw_data = pd.read_table(data, index_col=None)
-
-    # filtered_data = RauLCF(raw_data, cond_col)
-    filtered_data = raw_data
-    filtered_data = filtered_data.apply(lambda x: pd.to_numeric(x.convert_dtypes()))
-
-    ml_biomarkers = run_xgb(filtered_data, cond_col, top_importance, n_obs, n_iter)
-
-    results = run_utest(ml_biomarkers, cond_col)
-
-    results.to_csv(output_stat, sep="\t", index=False)
-
-    heatmap_vars=results['Gene'].tolist()
-    heatmap_vars.append(cond_col)
-
-    raw_data[heatmap_vars].sort_values(by=cond_col).to_csv(output_hm, sep="\t", index=False)
+    with progress.stage('read'):
+        if data.endswith(matrix_io.EXTENSION):
+            # Already typed: float32 genes and a condition column, memory-mapped
+            raw_data = matrix_io.read_dataframe(data)
+            float_format = '%.7g'  # float32 precision, integer counts are written without a decimal point
+        else:
+            raw_data = pd.read_table(data, index_col=None)
+            float_format = None
+            if low_memory:
+                # A single float32 block, as from matrix_io, is passed to the models without copies
+                expr = raw_data.drop(columns=[cond_col])
+                condition = raw_data[cond_col].to_numpy()
+                raw_data = pd.DataFrame(expr.to_numpy(dtype='float32'), columns=expr.columns, copy=False)
+                raw_data[cond_col] = condition
+                del expr
+                float_format = '%.7g'
+
+    samples = None
+    if incremental and cache_dir:
+        raw_genes, raw_matrix, raw_labels = expression_matrix(raw_data, cond_col)
+        samples = (raw_genes, param_cache.sample_hashes(raw_matrix, raw_labels))
+        del raw_matrix
+
+    checkpoint = checkpoints.load(checkpoint_dir, 'filter')
+    if checkpoint:
+        filtered_data = raw_data[checkpoint['genes'].tolist() + [cond_col]]
+    else:
+        with progress.stage('filter', raw_data.shape):
+            filtered_data = RauLCF(raw_data, cond_col)
+        checkpoints.save(checkpoint_dir, 'filter', genes=filtered_data.columns.drop(cond_col).to_numpy(dtype=str))
+    if float_format is None:
+        filtered_data = filtered_data.apply(lambda x: pd.to_numeric(x.convert_dtypes()))
+
+    checkpoint = checkpoints.load(checkpoint_dir, 'utest')
+    if checkpoint:
+        results = pd.DataFrame(checkpoint)
+    else:
+        with threadpool_limits(limits=split_thread_budget(n_threads)['stability_jobs'], user_api='blas'):
+            ml_biomarkers = run_models(filtered_data, cond_col, top_importance, n_obs, n_iter, models, n_threads,
+                                       search, search_time_budget, search_max_evals, cache_dir, cache_size,
+                                       checkpoint_dir, low_memory, enet_l1_ratio, samples)
+
+            with progress.stage('utest', ml_biomarkers.shape):
+                results = run_utest(ml_biomarkers, cond_col)
+        checkpoints.save(checkpoint_dir, 'utest', **{col: np.asarray(results[col].tolist()) for col in results.columns})
+
+    with progress.stage('export', results.shape):
+        results.to_csv(output_stat, sep="\t", index=False)
+
+        heatmap_vars=results['Gene'].tolist()
+        heatmap_vars.append(cond_col)
+
+        raw_data[heatmap_vars].sort_values(by=cond_col).to_csv(output_hm, sep="\t", index=False,
+                                                               float_format=float_format)
+
+        if compress_results:
+            artifacts.compress(output_stat)
+            artifacts.compress(output_hm)
+
+    checkpoints.clear(checkpoint_dir)
 
     return results
 
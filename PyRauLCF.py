@@ -1,89 +1,66 @@
-#pythonnet setup
-from pythonnet import load
-load("coreclr")
-import clr
-import os
-pathDLL = os.getcwd() + "\\RauLowCountsFilter.dll"
-clr.AddReference(pathDLL)
-from RauLowCountsFilter import RauLCF
-
 import numpy as np
 import numpy.typing as npt
-from typing import Any
-import ctypes
-import System
-from System import Array, Int32
-from System.Runtime.InteropServices import GCHandle, GCHandleType
 
-_MAP_NP_NET = {
-    np.dtype('float32'): System.Single,
-    np.dtype('float64'): System.Double,
-    np.dtype('int8')   : System.SByte,
-    np.dtype('int16')  : System.Int16,
-    np.dtype('int32')  : System.Int32,
-    np.dtype('int64')  : System.Int64,
-    np.dtype('uint8')  : System.Byte,
-    np.dtype('uint16') : System.UInt16,
-    np.dtype('uint32') : System.UInt32,
-    np.dtype('uint64') : System.UInt64,
-    np.dtype('bool')   : System.Boolean,
-}
-_MAP_NET_NP = {
-    'Single' : np.dtype('float32'),
-    'Double' : np.dtype('float64'),
-    'SByte'  : np.dtype('int8'),
-    'Int16'  : np.dtype('int16'), 
-    'Int32'  : np.dtype('int32'),
-    'Int64'  : np.dtype('int64'),
-    'Byte'   : np.dtype('uint8'),
-    'UInt16' : np.dtype('uint16'),
-    'UInt32' : np.dtype('uint32'),
-    'UInt64' : np.dtype('uint64'),
-    'Boolean': np.dtype('bool'),
-}
 
-def asNetArray(npArray):
+def _jaccard_similarity(binary, groups):
+    '''
+    Mean Jaccard index of expressed gene sets over all pairs of samples from the same group, pooled across groups
+    (as EvaluateMean of the .NET filter did). A pair with no expressed genes has an empty union, its index is NaN
+    (0/0), and so is the mean.
+    '''
+    similarities = []
+    for group in groups:
+        sub = binary[group]
+        intersection = sub @ sub.T
+        counts = np.diag(intersection)
+        union = counts[:, None] + counts[None, :] - intersection
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jaccard = intersection / union
+        similarities.append(jaccard[np.triu_indices(len(group), k=1)])
+    return float(np.concatenate(similarities).mean())
+
+
+def FindOptimalThreshold(npMatrix: npt.NDArray[np.float32], vector: list[str], min: float, max: float, count: int):
     '''
-    Given a `numpy.ndarray` returns a CLR `System.Array`.  See _MAP_NP_NET for 
-    the mapping of Numpy dtypes to CLR types.
+    Rau et al. low counts filter: picks the threshold from `count` evenly spaced values in [min, max]
+    that maximizes the similarity of expressed genes (counts at or above the threshold) between replicates.
+    As in the .NET filter, a threshold is only taken if its similarity is above 0 and not NaN, otherwise
+    the threshold is 0.
+
+    Genes are sorted by their maximal counts once, so for every threshold only the prefix of genes
+    whose maximum reaches it takes part in the pairwise products.
 
-    Note: `complex64` and `complex128` arrays are converted to `float32` 
-    and `float64` arrays respectively with shape [m,n,...] -> [m,n,...,2]
+    Arguments:
+    - npMatrix: a (samples, genes) array with counts/pseudocounts of genes expressions
+    - vector: conditions of the samples
+    - min, max, count: the thresholds grid
+
+    Returns:
+    - The optimal threshold
     '''
-    dims = npArray.shape
-    dtype = npArray.dtype
-    # For complex arrays, we must make a view of the array as its corresponding 
-    # float type.
-    if dtype == np.complex64:
-        dtype = np.dtype('float32')
-        dims.append(2)
-        npArray = npArray.view(np.float32).reshape(dims)
-    elif dtype == np.complex128:
-        dtype = np.dtype('float64')
-        dims.append(2)
-        npArray = npArray.view(np.float64).reshape(dims)
+    matrix = np.asarray(npMatrix, dtype='float32')
+    vector = np.asarray(vector)
+    if matrix.shape[0] != len(vector):
+        raise ValueError('Matrix height must be equal to vector length.')
+
+    # Groups with a single sample have no pairs of replicates
+    groups = [np.flatnonzero(vector == g) for g in np.unique(vector)]
+    groups = [group for group in groups if len(group) > 1]
+    if not groups:
+        return 0.
 
-    netDims = Array.CreateInstance(Int32, npArray.ndim)
-    for I in range(npArray.ndim):
-        netDims[I] = Int32(dims[I])
-    
-    if not npArray.flags.c_contiguous:
-        npArray = npArray.copy(order='C')
-    assert npArray.flags.c_contiguous
+    gene_max = matrix.max(axis=0)
+    order = np.argsort(-gene_max, kind='stable')
+    matrix, gene_max = matrix[:, order], gene_max[order]
 
-    try:
-        netArray = Array.CreateInstance(_MAP_NP_NET[dtype], netDims)
-    except KeyError:
-        raise NotImplementedError("asNetArray does not yet support dtype {}".format(dtype))
+    thresholds = np.linspace(min, max, count)
+    # Number of genes with maximum at or above each threshold
+    n_genes = np.searchsorted(-gene_max, -thresholds, side='right')
 
-    try: # Memmove 
-        destHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
-        sourcePtr = npArray.__array_interface__['data'][0]
-        destPtr = destHandle.AddrOfPinnedObject().ToInt64()
-        ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
-    finally:
-        if destHandle.IsAllocated: destHandle.Free()
-    return netArray
+    similarities = np.array([_jaccard_similarity((matrix[:, :n] >= threshold).astype('float32'), groups)
+                             for threshold, n in zip(thresholds, n_genes)])
 
-def FindOptimalThreshold(npMatrix: np.ndarray[np.float32, np.shape([Any, Any])], vector: list[str], min: float, max: float, count: int):
-    return RauLCF.FindOptimalThreshold(asNetArray(npMatrix), vector, min, max, count)[0];
\ No newline at end of file
+    valid = similarities > 0  # False for NaN
+    if not valid.any():
+        return 0.
+    return float(thresholds[np.argmax(np.where(valid, similarities, -np.inf))])
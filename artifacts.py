@@ -0,0 +1,113 @@
+'''
+Content-addressed store of job files. Every file is kept once in the store directory next to it,
+as store/<2 hex digits>/<sha256 of the content><suffix>, and the job files (data/<token>.expr,
+data/<token>_stat.txt.gz, ...) are hard links to it. Identical uploads and identical results of different jobs
+share the disk space, and the number of links of a blob shows how many files use it.
+Result text files are gzip-compressed: pandas reads them transparently and they are downloaded as they are.
+'''
+
+import gzip
+import hashlib
+import os
+import shutil
+
+STORE_DIR = 'store'
+CHUNK_SIZE = 2 ** 20
+COMPRESS_LEVEL = 6
+GZIP_SUFFIX = '.gz'
+
+
+def file_digest(fn):
+    '''
+    Function that hashes a file by chunks.
+
+    Returns:
+    - sha256 hex digest of the file content
+    '''
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def blob_path(fn, digest, suffix=''):
+    '''
+    Path of a blob in the store of the directory of fn.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(fn)), STORE_DIR, digest[:2], f'{digest}{suffix}')
+
+
+def put(fn, suffix=''):
+    '''
+    Function that moves a file into the store and leaves a hard link to the blob in its place.
+    If the store already has the same content, the file is replaced with a link to the existing blob.
+    Files on a filesystem without hard links are left as they are.
+
+    Arguments:
+    - fn: file name
+    - suffix: blob file suffix, e.g. the extension of the file
+
+    Returns:
+    - The blob path, or None if the file was left as it is
+    '''
+    blob_fn = blob_path(fn, file_digest(fn), suffix)
+    try:
+        os.makedirs(os.path.dirname(blob_fn), exist_ok=True)
+        try:
+            os.link(fn, blob_fn)  # new content, the file itself becomes the blob
+        except FileExistsError:
+            # Replaced atomically, so a reader never sees a missing file
+            tmp_fn = f'{fn}.{os.getpid()}.tmp'
+            os.link(blob_fn, tmp_fn)
+            os.replace(tmp_fn, fn)
+    except OSError:
+        return None
+    return blob_fn
+
+
+def compress(fn):
+    '''
+    Function that replaces a text file with its gzip-compressed copy in the store.
+    The gzip header has no name and time, so the same text always gives the same blob.
+
+    Arguments:
+    - fn: file name, the compressed file is fn + '.gz'
+
+    Returns:
+    - The name of the compressed file
+    '''
+    gz_fn = f'{fn}{GZIP_SUFFIX}'
+    tmp_fn = f'{gz_fn}.{os.getpid()}.tmp'
+    with open(fn, 'rb') as src, open(tmp_fn, 'wb') as f:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=COMPRESS_LEVEL, fileobj=f, mtime=0) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(tmp_fn, gz_fn)
+    os.remove(fn)
+    put(gz_fn, GZIP_SUFFIX)
+    return gz_fn
+
+
+def resolve(fn):
+    '''
+    Function that finds a job file: the file itself or its compressed copy.
+
+    Returns:
+    - fn if it exists, else fn + '.gz' if that exists, else fn
+    '''
+    if not os.path.exists(fn) and os.path.exists(f'{fn}{GZIP_SUFFIX}'):
+        return f'{fn}{GZIP_SUFFIX}'
+    return fn
+
+
+def gzip_bytes(fn):
+    '''
+    Function that returns the gzip-compressed content of a job file, e.g. for a download.
+    A compressed file is read as it is.
+    '''
+    fn = resolve(fn)
+    with open(fn, 'rb') as f:
+        content = f.read()
+    if fn.endswith(GZIP_SUFFIX):
+        return content
+    return gzip.compress(content, compresslevel=COMPRESS_LEVEL, mtime=0)
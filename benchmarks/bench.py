@@ -0,0 +1,197 @@
+'''
+Benchmarks of MarkerFinder stages on synthetic RNA-seq count matrices.
+
+Usage (from the repository root):
+    python benchmarks/bench.py --samples 60 --genes 5000 --groups 3 --markers 30
+    python benchmarks/bench.py --compare benchmarks/results/<previous>.json
+
+Every stage is timed --repeat times (the best time is reported) and then run once more under tracemalloc
+for its peak memory. tracemalloc only sees allocations of this process (numpy arrays included), not of
+worker processes of the search and stability selection. The data is generated from a fixed seed, so runs with the same arguments are comparable.
+Results are written to benchmarks/results/ as json.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)  # dash_app reads its assets relative to the working directory
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import Main
+import matrix_io
+
+
+def generate_counts(n_samples, n_genes, n_groups, n_markers, fold_change=4., dispersion=0.4, seed=0):
+    '''
+    Function that generates a negative binomial count matrix with planted markers.
+    Gene means are log-normal; each marker gene has its mean multiplied by fold_change in one of the groups.
+
+    Arguments:
+    - n_samples: number of samples, split evenly between groups
+    - n_genes: number of genes
+    - n_groups: number of conditions
+    - n_markers: number of marker genes
+    - fold_change: mean fold change of markers in their group
+    - dispersion: negative binomial dispersion (variance = mean + dispersion * mean^2)
+    - seed: random seed
+
+    Returns:
+    - A dataframe with counts and a condition column, and the list of marker genes
+    '''
+    rng = np.random.default_rng(seed)
+    condition = np.arange(n_samples) % n_groups
+    genes = np.array([f'GENE{i:06d}' for i in range(n_genes)])
+
+    means = np.tile(rng.lognormal(mean=2., sigma=2., size=n_genes), (n_samples, 1))
+    markers = rng.choice(n_genes, size=n_markers, replace=False)
+    for i, gene in enumerate(markers):
+        means[condition == i % n_groups, gene] *= fold_change
+
+    # numpy parametrization: n = 1 / dispersion, p = n / (n + mean)
+    n = 1 / dispersion
+    counts = rng.negative_binomial(n, n / (n + means)).astype('int64')
+
+    df = pd.DataFrame(counts, columns=genes)
+    df['condition'] = condition
+    return df, genes[markers].tolist()
+
+
+def measure(func, repeat):
+    '''
+    Best wall-clock time of func over repeat runs, then its peak traced memory in a separate run.
+
+    Returns:
+    - A tuple (result of the last run, seconds, peak MB)
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, min(times), peak / 2 ** 20
+
+
+def run(args):
+    df, markers = generate_counts(args.samples, args.genes, args.groups, args.markers, seed=args.seed)
+    cells = args.samples * args.genes
+    stages = {}
+
+    def record(name, func, items=cells):
+        result, seconds, peak_mb = measure(func, args.repeat)
+        stages[name] = {'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 1),
+                        'cells_per_second': round(items / seconds) if seconds else None}
+        print(f'{name:>10}: {seconds:9.4f} s  {peak_mb:9.1f} MB')
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        text_fn, expr_fn = f'{tmp}/counts.csv', f'{tmp}/counts{matrix_io.EXTENSION}'
+        df.to_csv(text_fn, index=False)
+
+        record('ingestion', lambda: matrix_io.convert_text(text_fn, expr_fn))
+        data = matrix_io.read_dataframe(expr_fn)
+
+        filtered = record('filter', lambda: Main.RauLCF(data, 'condition'))
+
+        genes = filtered.columns.drop('condition')
+        matrix = filtered[genes].to_numpy(dtype='float32')
+        labels = filtered['condition'].to_numpy(dtype='int64')
+        search_space = {
+            'n_estimators': (5, 500),
+            'learning_rate': (0.0001, 0.9),
+            'booster': ("gbtree", "gblinear", "dart"),
+            'reg_alpha': (0.0001, 1)
+        }
+        params = record('search', lambda: Main.halving_search_xgb(matrix, labels, search_space,
+                                                                  n_threads=args.threads))
+
+        clf = xgb.XGBClassifier(**params, objective="multi:softmax", num_class=str(args.groups),
+                                n_jobs=1, random_state=500)
+        importances = record('stability', lambda: Main.collect_importances(matrix, labels, clf, args.n_iter,
+                                                                           n_jobs=args.threads))
+        enet = record('enet', lambda: Main.enet_importances(matrix, labels, args.n_iter, n_threads=args.threads))
+
+        counts = [Main.stability_counts(importances, 50), Main.stability_counts(enet, 50)]
+        stable = genes[Main.select_stable_genes(np.mean(counts, axis=0), args.n_iter, 0.5)]
+        selected = filtered[stable.tolist() + ['condition']]
+
+        results = record('utest', lambda: Main.run_utest(selected, 'condition'),
+                         items=selected.shape[0] * selected.shape[1])
+
+        hm_fn = f'{tmp}/counts_hm.txt'
+        hm_vars = results['Gene'].tolist() + ['condition']
+        record('export', lambda: data[hm_vars].sort_values(by='condition').to_csv(hm_fn, sep='\t', index=False,
+                                                                                   float_format='%.7g'),
+               items=data.shape[0] * len(hm_vars))
+
+        import dash_app
+        hm = pd.read_csv(hm_fn, sep='\t')
+        hm = hm[hm.columns[::-1]]  # Condition must be the first row
+        record('heatmap', lambda: dash_app.get_heatmap(hm), items=hm.shape[0] * hm.shape[1])
+
+    found = len(set(markers) & set(stable))
+    print(f'Planted markers found by stability selection: {found}/{len(markers)}')
+
+    return {'args': vars(args),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'xgboost': xgb.__version__, 'cpus': os.cpu_count(),
+                            'machine': platform.machine()},
+            'markers_found': found,
+            'stages': stages}
+
+
+def compare(current, previous):
+    print(f'\n{"stage":>10}  {"time ratio":>10}  {"memory ratio":>12}')
+    for name, stage in current['stages'].items():
+        if name not in previous['stages']:
+            continue
+        before = previous['stages'][name]
+        time_ratio = stage['seconds'] / before['seconds'] if before['seconds'] else float('nan')
+        mem_ratio = stage['peak_mb'] / before['peak_mb'] if before['peak_mb'] else float('nan')
+        flag = '  <-- slower' if time_ratio > 1.2 else ''
+        print(f'{name:>10}  {time_ratio:10.2f}  {mem_ratio:12.2f}{flag}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=60)
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=2)
+    parser.add_argument('--markers', type=int, default=20)
+    parser.add_argument('--n-iter', type=int, default=20, help='stability selection iterations')
+    parser.add_argument('--threads', type=int, default=None, help='threads for search and stability selection')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', help='json results of a previous run')
+    parser.add_argument('--output', default=os.path.join(root, 'benchmarks', 'results'))
+    args = parser.parse_args()
+
+    compare_fn, output = args.compare, args.output
+    del args.compare, args.output
+    current = run(args)
+
+    os.makedirs(output, exist_ok=True)
+    fn = os.path.join(output, f'{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(fn, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'Results saved to {fn}')
+
+    if compare_fn:
+        with open(compare_fn) as f:
+            compare(current, json.load(f))
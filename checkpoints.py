@@ -0,0 +1,61 @@
+'''
+Checkpoints of MarkerFinder stages. Every stage output is saved into the job's checkpoint directory as an
+.npz file, so a retried job loads the completed stages and continues from the first missing one.
+'''
+
+import os
+import shutil
+
+import numpy as np
+
+
+def save(checkpoint_dir, name, **arrays):
+    '''
+    Function that saves a checkpoint. Nothing is saved if checkpoint_dir is None.
+
+    Arguments:
+    - checkpoint_dir: checkpoint directory of the job
+    - name: checkpoint name
+    - arrays: arrays (or strings) to save
+    '''
+    if checkpoint_dir is None:
+        return
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # A job killed while writing must not leave a partial checkpoint
+    fn = os.path.join(checkpoint_dir, f'{name}.npz')
+    tmp_fn = f'{fn}.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fn, fn)
+
+
+def load(checkpoint_dir, name):
+    '''
+    Function that loads a checkpoint.
+
+    Arguments:
+    - checkpoint_dir: checkpoint directory of the job
+    - name: checkpoint name
+
+    Returns:
+    - A dict with saved arrays, or None if there is no such checkpoint
+    '''
+    if checkpoint_dir is None:
+        return None
+    try:
+        with np.load(os.path.join(checkpoint_dir, f'{name}.npz')) as checkpoint:
+            return {key: checkpoint[key] for key in checkpoint.files}
+    except FileNotFoundError:
+        return None
+
+
+def clear(checkpoint_dir):
+    '''
+    Function that removes all checkpoints of a job.
+
+    Arguments:
+    - checkpoint_dir: checkpoint directory of the job
+    '''
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
@@ -1,8 +1,7 @@
 import base64
-import io
 import os
-import sqlite3
 import time
+from functools import lru_cache
 from secrets import token_urlsafe
 from threading import Timer
 
@@ -12,12 +11,21 @@ from furl import furl
 import pandas as pd
 import numpy as np
 
+from flask import request, jsonify
 from dash import Dash, dcc, html, dash_table, Input, Output, State, ctx
 from dash.dash_table.Format import Format, Scheme
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 
+import artifacts
+import job_store
+import matrix_io
+import result_cache
+from progress import job_status
+from redis import Redis
+from redis.exceptions import RedisError
+
 path = f'{os.path.abspath(os.curdir)}/'
 
 external_stylesheets = [dbc.themes.BOOTSTRAP, "assets/segmentation-style.css"]
@@ -26,6 +34,16 @@ app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 server = app.server
 app.title = 'BioKoshmarkers'
 
+UPLOAD_CHUNK_SIZE = 2 ** 20  # bytes read or decoded at once while saving uploads
+GENE_DB_URL = "https://www.ncbi.nlm.nih.gov/gene/?term="
+HEATMAP_MAX_ROWS = 400  # larger heatmaps are downsampled to about screen resolution
+HEATMAP_MAX_COLS = 600
+HEATMAP_CACHE_SIZE = 32  # built heatmap figures kept per process
+
+redis_conn = Redis(host='localhost', port=6379, db=0)
+
+_job_files = {}  # job token -> file name of its results, it doesn't change once the job is registered
+
 # App Layout
 
 # Howto button
@@ -196,18 +214,20 @@ data_table = dash_table.DataTable(
         dict(id='pval', name='p-value', type='numeric', format=Format(precision=2, scheme=Scheme.exponent)),
         dict(id='padj', name='p-value (adj)', type='numeric', format=Format(precision=2, scheme=Scheme.exponent))
     ],
-    data=[{}],  # Input
+    data=[{}],  # Input, only the current page (see table_page)
     editable=False,
-    filter_action="native",
-    sort_action="native",
+    filter_action="custom",
+    sort_action="custom",
     sort_mode="multi",
+    sort_by=[],
     column_selectable="single",
     row_selectable='multi',
     selected_columns=[],
     selected_rows=[],
-    page_action="native",
+    page_action="custom",
     page_current=0,
     page_size=10,
+    page_count=1,
     style_cell={
         'overflow': 'hidden',
         'textOverflow': 'ellipsis',
@@ -303,58 +323,101 @@ violin_graph = html.Div(
     ])
 
 
-def get_heatmap(hm) -> go.Figure:
+def _bin_edges(n, max_bins):
+    """
+    Edges of at most max_bins bins of consecutive items, sizes differ by one at most
+    :param int n: number of items
+    :param int max_bins:
+    :return: np.ndarray
+    """
+    return np.unique(np.linspace(0, n, min(n, max_bins) + 1).astype(int))
+
+
+def get_heatmap(hm, max_rows=HEATMAP_MAX_ROWS, max_cols=HEATMAP_MAX_COLS) -> go.Figure:
     """
     Create heatmap from passed DataFrame
     Important!!! "Condition" must be the first column in hm
 
+    Groups are separated with a border line. A heatmap larger than max_rows x max_cols is downsampled:
+    neighbouring samples of a group and neighbouring genes are averaged. Hover texts are built in the browser
+    from the gene and the row names, instead of being sent for every cell.
+
     :param pd.DataFrame hm:
+    :param int max_rows: maximal number of rows (samples and border lines)
+    :param int max_cols: maximal number of columns (genes)
     :return:
     """
-
-    # Create hovertext data. May be suboptimal...
-    text = hm[hm.columns[1:]].values.astype(str).tolist()  # all columns except "Condition"
-    cols = hm.columns.tolist()
-    for i, row in enumerate(text):
-        text[i] = [f"Gene: {gene}<br>Group: {hm.loc[i, 'condition']}<br>Counts: {counts}"
-                   for gene, counts in zip(cols, row)]
-
-    # Y-axis legend
-    y_ticks = pd.Series(data="", index=hm.index, dtype=str)
-    prev_stack_len = 0  # for correct tick positioning
-    for i in hm.condition.unique():
-        cond_len = hm.loc[hm.condition == i].shape[0]  # length of condition
-        cond_pos = prev_stack_len + cond_len // 2
+    condition = hm['condition'].to_numpy()
+    genes = hm.columns[1:]
+    z = hm[genes].to_numpy(dtype='float64')
+
+    # Genes
+    edges = _bin_edges(len(genes), max_cols)
+    if len(edges) - 1 < len(genes):
+        z = np.add.reduceat(z, edges[:-1], axis=1) / np.diff(edges)
+        x = [genes[start] if stop - start == 1 else f"{genes[start]} ... {genes[stop - 1]} ({stop - start} genes)"
+             for start, stop in zip(edges[:-1], edges[1:])]
+    else:
+        x = genes.tolist()
+
+    # Samples of every group, followed by a border line
+    groups = pd.unique(condition)
+    n_samples = max(len(condition), 1)
+    border = np.full((1, z.shape[1]), np.nanmax(z) if z.size else 0.)
+    blocks, y, tickvals, ticktext = [], [], [], []
+    for i, group in enumerate(groups):
+        if i:  # No borderline for first group (edge of heatmap)
+            blocks.append(border)
+            y.append(f"Group border line {i}")
+
+        group_z = z[condition == group]
+        group_rows = max(max_rows * len(group_z) // n_samples, 1)
+        edges = _bin_edges(len(group_z), group_rows)
+        if len(edges) - 1 < len(group_z):
+            group_z = np.add.reduceat(group_z, edges[:-1], axis=0) / np.diff(edges)[:, None]
+        # Row names are unique, they are categories of the Y-axis
+        y.extend(f"{group}, sample {start + 1}" if stop - start == 1 else f"{group}, samples {start + 1}-{stop}"
+                 for start, stop in zip(edges[:-1], edges[1:]))
 
         # Y-axis text position
-        y_ticks.loc[cond_pos] = str(i)
+        tickvals.append(y[len(y) - len(group_z) + len(group_z) // 2])
+        ticktext.append(str(group))
+        blocks.append(group_z)
 
-        if hm.loc[0, 'condition'] == i:  # No borderline for first group (edge of heatmap)
-            prev_stack_len += cond_len
-            continue
-
-        # insert a row after cond_one_pos to make it visible
-        line = pd.DataFrame(data=hm.max().max(), columns=hm.columns, index=[0])
-        hm = pd.concat([hm.loc[:prev_stack_len - 1], line, hm.loc[prev_stack_len:]]).reset_index(drop=True)
-        text.insert(prev_stack_len, ['Group border line'] * len(text[0]))
-
-        prev_stack_len += cond_len + 1
-        y_ticks.loc[y_ticks.shape[0]] = ""  # add empty line to fit hm.shape
-
-    hm = hm.drop(columns='condition')
+    z = np.concatenate(blocks) if blocks else z
 
     fig = go.Figure()
     fig.add_trace(
-        go.Heatmap(z=hm, x=hm.columns,
-                   hoverinfo='text', hovertext=text)
+        go.Heatmap(z=z, x=x, y=y,
+                   hovertemplate="Gene: %{x}<br>Group: %{y}<br>Counts: %{z}<extra></extra>")
     ).update_layout(margin={'l': 0, 'r': 10, 't': 0, 'b': 0})
 
-    fig.update_yaxes(tickmode='array',
-                     tickvals=np.arange(0, hm.shape[0]),
-                     ticktext=y_ticks)
+    fig.update_yaxes(type='category',
+                     tickmode='array',
+                     tickvals=tickvals,
+                     ticktext=ticktext)
     return fig
 
 
+@lru_cache(maxsize=HEATMAP_CACHE_SIZE)
+def _cached_heatmap(hm_fn, genes, mtime):
+    results = result_cache.load(f"{path}data/", hm_fn.removesuffix('_hm.txt'))
+    if genes is not None:
+        genes = [gene for gene in genes if gene in results.gene_index]
+    return get_heatmap(results.heatmap_frame(genes))  # Whole file by default
+
+
+def heatmap_figure(hm_fn, genes=None) -> go.Figure:
+    """
+    Heatmap of a job's results, built figures are cached by the job file, its modification time and genes
+    :param str hm_fn: heatmap dataset file name, in data/
+    :param genes: genes to show, all by default
+    :return:
+    """
+    genes = None if genes is None else tuple(sorted(set(genes)))  # columns are kept in the order of the file
+    return _cached_heatmap(hm_fn, genes, os.path.getmtime(artifacts.resolve(f"{path}data/{hm_fn}")))
+
+
 def get_violin(hm, gene):
     fig = go.Figure()
     fig.add_violin(y=hm[gene], x=hm['condition'])
@@ -387,31 +450,58 @@ def demo(demo_clicks):
 def download_template(demo_clicks, stat_fn, hm_fn):
     if not demo_clicks or not stat_fn or not hm_fn:
         raise PreventUpdate
-    return dcc.send_file(f"{path}data/{stat_fn}"), dcc.send_file(f"{path}data/{hm_fn}")
+    # Results are sent gzip-compressed, compressed files as they are
+    return (dcc.send_bytes(artifacts.gzip_bytes(f"{path}data/{stat_fn}"), f"{stat_fn}{artifacts.GZIP_SUFFIX}"),
+            dcc.send_bytes(artifacts.gzip_bytes(f"{path}data/{hm_fn}"), f"{hm_fn}{artifacts.GZIP_SUFFIX}"))
 
 
-def parse_contents(contents, filename):
+def save_upload(contents, raw_fn):
     """
-    Read raw input data
+    Decode dcc.Upload contents to a file by chunks, without a second in-memory copy of the whole file
+    :param str contents: 'data:<type>;base64,<data>' string
+    :param str raw_fn: output file name
+    :return:
     """
-    content_type, content_string = contents.split(',')
+    start = contents.index(',') + 1
+    step = UPLOAD_CHUNK_SIZE // 3 * 4  # a multiple of 4, so every chunk is valid base64
+    with open(raw_fn, 'wb') as f:
+        for i in range(start, len(contents), step):
+            f.write(base64.b64decode(contents[i:i + step]))
+
 
-    decoded = base64.b64decode(content_string)
+def ingest_upload(raw_fn, filename, job_token):
+    """
+    Parse raw input data once and convert it into the binary matrix format. The raw file is removed.
+    The matrix goes to the artifact store, so an identical upload shares the file with the previous one.
+    :param str raw_fn: uploaded file
+    :param str filename: user's file name, only the extension is used
+    :param str job_token:
+    :return: (samples, genes) shape or an error message
+    """
+    expr_fn = f"{path}data/{job_token}{matrix_io.EXTENSION}"
     try:
-        if '.csv' in filename:
-            # Assume that the user uploaded a CSV file
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-        elif '.txt' in filename:
-            # Assume that the user uploaded an Excel file
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), sep='\t')
+        if filename.endswith('.csv'):
+            shape = matrix_io.convert_text(raw_fn, expr_fn, sep=',')
+        elif filename.endswith(('.txt', '.tsv')):
+            shape = matrix_io.convert_text(raw_fn, expr_fn, sep='\t')
         elif '.xls' in filename:
-            # Assume that the user uploaded an Excel file
-            df = pd.read_excel(io.BytesIO(decoded))
+            # Excel files can't be read by chunks
+            shape = matrix_io.write_dataframe(expr_fn, pd.read_excel(raw_fn))
         else:
             return f'File format not supported. Recommended file formats: tsv or csv'
     except Exception as e:
         return f'There was an error processing this file: {e}'
-    return df
+    finally:
+        os.remove(raw_fn)
+    artifacts.put(expr_fn, matrix_io.EXTENSION)
+    return shape
+
+
+def register_job(filename, job_token, n_obs):
+    """
+    Add an unconfirmed job to the db, it's confirmed later in Telegram
+    """
+    job_store.add_job(filename, job_token, job_token, n_obs)
 
 
 def create_link_to_telegram():
@@ -441,37 +531,155 @@ def create_link_to_telegram():
 def submit_file(contents, filename, n_obs):
     if not contents:
         raise PreventUpdate
-    else:
-        df = parse_contents(contents, filename)
-        if isinstance(df, str) or not n_obs:
-            return True, False, True, "secondary", "https://t.me/koshmarkersbot"  # Raise alert if failed to parse input
-
-    # checks were passed in load_file
-    df = parse_contents(contents, filename)
+    if not n_obs:
+        return True, False, True, "secondary", "https://t.me/koshmarkersbot"  # Raise alert if failed to parse input
 
     # Create link and token for a job, load into db for further auth in Telegram
     tg_link, job_token = create_link_to_telegram()
 
     # Write file with token as name, filename is kept only for notifications
-    df.to_csv(f"./data/{job_token}.csv", sep='\t', index=False)
+    raw_fn = f"{path}data/{job_token}.upload"
+    save_upload(contents, raw_fn)
+    if isinstance(ingest_upload(raw_fn, filename, job_token), str):
+        return True, False, True, "secondary", "https://t.me/koshmarkersbot"  # Raise alert if failed to parse input
 
-    with sqlite3.connect("tg/jobs.db") as con:
-        cur = con.cursor()
-        cur.execute("INSERT INTO jobs (user_filename, filename, job_token, n_obs) VALUES (?, ?, ?, ?)",
-                    (filename, job_token, job_token, int(n_obs)))
-        con.commit()
-    con.close()
+    register_job(filename, job_token, n_obs)
 
     return False, True, False, "primary", f"https://t.me/koshmarkersbot?start={job_token}"  # Open a button with a link to tg
 
 
+# Streaming upload for large files, e.g.
+# curl -T data.csv "http://localhost:8070/upload?filename=data.csv&n_obs=10"
+@server.route('/upload', methods=['POST', 'PUT'])
+def upload_stream():
+    filename = request.args.get('filename', '')
+    n_obs = request.args.get('n_obs', type=int)
+    if not filename or not n_obs:
+        return jsonify(error='filename and n_obs must be specified'), 400
+
+    tg_link, job_token = create_link_to_telegram()
+
+    # Request body goes straight to disk
+    raw_fn = f"{path}data/{job_token}.upload"
+    with open(raw_fn, 'wb') as f:
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
+
+    shape = ingest_upload(raw_fn, filename, job_token)
+    if isinstance(shape, str):
+        return jsonify(error=shape), 400
+
+    register_job(filename, job_token, n_obs)
+
+    return jsonify(token=job_token, samples=shape[0], genes=shape[1], link=tg_link)
+
+
+# DataTable filter operators, the first one of each row is the name used in filter_stat()
+FILTER_OPERATORS = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    """
+    Parse one condition of a DataTable filter query, e.g. '{padj} < 0.05'
+    :param str filter_part:
+    :return: (column, operator, value), Nones if the condition is not recognized
+    """
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                if not value_part:
+                    return None, None, None
+                v0 = value_part[0]
+                operator_name = operator_type[0].strip()
+                if v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                elif operator_name in ('contains', 'datestartswith'):  # text as typed, e.g. '1' not '1.0'
+                    value = value_part
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_name, value
+
+    return None, None, None
+
+
+def filter_stat(stat, filter_query):
+    """
+    Apply a DataTable filter query to the stat table
+    :param pd.DataFrame stat:
+    :param str filter_query: conditions joined with ' && '
+    :return: pd.DataFrame
+    """
+    mask = np.ones(len(stat), dtype=bool)
+    for filter_part in (filter_query or '').split(' && '):
+        col_name, operator, value = split_filter_part(filter_part)
+        if col_name not in stat.columns:
+            continue
+
+        col = stat[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if pd.api.types.is_numeric_dtype(col) and not isinstance(value, float):
+                continue  # not a number typed into a numeric column
+            if not pd.api.types.is_numeric_dtype(col):
+                col, value = col.astype(str), str(value)
+            mask &= getattr(col, operator)(value).to_numpy()
+        elif operator == 'contains':
+            mask &= col.astype(str).str.contains(str(value), regex=False).to_numpy()
+        elif operator == 'datestartswith':
+            mask &= col.astype(str).str.startswith(str(value)).to_numpy()
+
+    return stat[mask]
+
+
+def table_records(stat):
+    """
+    DataTable rows of the stat table, with row ids and links to the gene database
+    :param pd.DataFrame stat:
+    :return: list of dicts
+    """
+    records = stat.assign(id=stat.index).to_dict('records')
+    for row in records:
+        row["Gene"] = f"[{row['Gene']}]({GENE_DB_URL}{row['Gene']})"
+    return records
+
+
+def job_filename(job_token):
+    """
+    File name of the job results
+    :param str job_token:
+    :return: file name or None if there is no such job
+    """
+    if job_token not in _job_files:
+        fn = job_store.job_filename(job_token)
+        if fn is None:
+            return None
+        _job_files[job_token] = fn
+    return _job_files[job_token]
+
+
 # Retrieve calculated data
 @app.callback(
-    Output('data-table', 'data'),
     Output('data-table', 'selected_rows'),
+    Output('selected_ids', 'data'),
     Output('data-table', 'selected_cells'),
     Output('data-table', 'active_cell'),
     Output('data-table', 'filter_query'),
+    Output('data-table', 'sort_by'),
+    Output('data-table', 'page_current'),
     Output("heatmap_graph", "figure"),
     Output("stat_fn", "children"),
     Output("hm_fn", "children"),
@@ -491,34 +699,62 @@ def load_results(href: str, n_clicks: int, page_loaded: bool):
     except KeyError:  # no token provided
         raise PreventUpdate
 
-    with sqlite3.connect("tg/jobs.db") as con:
-        cur = con.cursor()
-        cur.execute("SELECT filename FROM jobs WHERE job_token=?", (job_token,))
-        fn = cur.fetchone()
+    fn = job_filename(job_token)
+    if fn is None or not os.path.exists(artifacts.resolve(f"{path}data/{fn}_stat.txt")):  # removed by retention
+        raise PreventUpdate
 
-        if fn:
-            fn = fn[0]
-        else:
-            raise PreventUpdate
+    # Table pages are sent by table_page
+    stat_fn = f"{fn}_stat.txt"
+    hm_fn = f"{fn}_hm.txt"
+    fig = heatmap_figure(hm_fn)
 
-    con.close()
+    return list(), list(), list(), None, "", list(), 0, fig, stat_fn, hm_fn, False
 
-    # Load files
-    stat_fn = f"{fn}_stat.txt"
-    stat_df = pd.read_csv(f"{path}data/{stat_fn}", sep='\t')
-    stat_df['id'] = stat_df.index
-    stat_df = stat_df.to_dict('records')
 
-    db_url = "https://www.ncbi.nlm.nih.gov/gene/?term="
-    for i, el in enumerate(stat_df):
-        stat_df[i]["Gene"] = f"[{el['Gene']}]({db_url}{el['Gene']})"
+# Current page of the table, filtered and sorted on the server
+@app.callback(
+    Output('data-table', 'data'),
+    Output('data-table', 'page_count'),
+    Output('data-table', 'page_current', allow_duplicate=True),
+    Output('data-table', 'selected_rows', allow_duplicate=True),
+    Input('data-table', 'page_current'),
+    Input('data-table', 'page_size'),
+    Input('data-table', 'sort_by'),
+    Input('data-table', 'filter_query'),
+    Input('stat_fn', 'children'),
+    State('selected_ids', 'data'),
+    prevent_initial_call=True
+)
+def table_page(page_current, page_size, sort_by, filter_query, stat_fn, selected_ids):
+    if not stat_fn:  # file not loaded
+        raise PreventUpdate
+
+    stat = result_cache.load(f"{path}data/", stat_fn.removesuffix('_stat.txt')).stat
+    stat = filter_stat(stat, filter_query)
+    if sort_by:
+        stat = stat.sort_values([col['column_id'] for col in sort_by],
+                                ascending=[col['direction'] == 'asc' for col in sort_by])
 
-    hm_fn = f"{fn}_hm.txt"
-    hm = pd.read_csv(f"{path}data/{hm_fn}", sep='\t')
-    hm = hm[hm.columns[::-1]]  # Condition must be the first row
-    fig = get_heatmap(hm)
+    page_count = max(-(-len(stat) // page_size), 1)
+    page_current = min(page_current or 0, page_count - 1)  # e.g. a filter left fewer pages
+    records = table_records(stat.iloc[page_current * page_size:(page_current + 1) * page_size])
 
-    return stat_df, list(), list(), None, "", fig, stat_fn, hm_fn, False
+    # Selection is kept by row ids across pages
+    selected_ids = set(selected_ids or [])
+    return records, page_count, page_current, [i for i, row in enumerate(records) if row['id'] in selected_ids]
+
+
+# Selected rows of all pages
+@app.callback(
+    Output('selected_ids', 'data', allow_duplicate=True),
+    Input('data-table', 'selected_row_ids'),
+    State('data-table', 'data'),
+    State('selected_ids', 'data'),
+    prevent_initial_call=True
+)
+def remember_selection(selected_row_ids, data, selected_ids):
+    page_ids = {row['id'] for row in data if 'id' in row}
+    return sorted((set(selected_ids or []) - page_ids) | set(selected_row_ids or []))
 
 
 # Table row info on data_table click
@@ -537,15 +773,15 @@ def table_row_info(active_cell, data, hm_fn):
     if not active_cell:
         return table_row_info_placeholder, figure_placeholder
 
-    selected_row = data[active_cell['row_id']]
-    selected_gene = selected_row["Gene"].split(']')[0].strip('[')  # [Gene](GeneDBURL?query=Gene) --> Gene
-
-    hm = pd.read_csv(f"{path}data/{hm_fn}", sep='\t', usecols=[selected_gene, 'condition'])
+    # Results are parsed once per job, see result_cache; row ids are indices of the stat table
+    results = result_cache.load(f"{path}data/", hm_fn.removesuffix('_hm.txt'))
+    selected_gene = results.stat.at[active_cell['row_id'], 'Gene']
+    hm = results.gene_frame(selected_gene)
     fig = get_violin(hm, gene=selected_gene)
 
     row_info = selected_gene if active_cell else table_row_info_placeholder
 
-    url = f"https://www.ncbi.nlm.nih.gov/gene/?term={selected_gene}"
+    url = f"{GENE_DB_URL}{selected_gene}"
 
     message = dcc.Link(row_info, href=url, target="_blank")
 
@@ -555,48 +791,68 @@ def table_row_info(active_cell, data, hm_fn):
 # Table row info on data_table click
 @app.callback(
     Output("heatmap_graph", "figure", allow_duplicate=True),
-    Input('data-table', "derived_virtual_data"),
-    Input('data-table', "derived_virtual_selected_rows"),
     Input('update-heatmap', "n_clicks"),
-    Input('data-table', 'filter_query'),
+    State('selected_ids', 'data'),
+    State('data-table', 'filter_query'),
     State("hm_fn", "children"),
     prevent_initial_call=True
 )
-def update_heatmap(rows, indices, n_clicks, filters_used, hm_fn):
-    # When the table is first rendered, `derived_virtual_data` and
-    # `derived_virtual_selected_rows` will be `None`. This is due to an
-    # idiosyncrasy in Dash (unsupplied properties are always None and Dash
-    # calls the dependent callbacks when the component is first rendered).
-    # So, if `rows` is `None`, then the component was just rendered
-    # and its value will be the same as the component's dataframe.
-    # Instead of setting `None` in here, you could also set
-    # `derived_virtual_data=df.to_rows('dict')` when you initialize
-    # the component.
-
+def update_heatmap(n_clicks, selected_ids, filters_used, hm_fn):
     if not hm_fn:  # file not loaded
         raise PreventUpdate
 
     if "update-heatmap" != ctx.triggered_id:  # button not pressed
         raise PreventUpdate
 
-    cols = None  # Whole file
-    if indices:  # Selected tick boxes
-        cols = [row['Gene'].split(']')[0].strip('[') for row in [rows[i] for i in indices]] + ['condition']
+    # The table only has the current page, genes are taken from the whole stat table
+    stat = result_cache.load(f"{path}data/", hm_fn.removesuffix('_hm.txt')).stat
+    genes = None  # Whole file
+    if selected_ids:  # Selected tick boxes, on any page
+        genes = stat.loc[selected_ids, 'Gene'].tolist()
     elif filters_used:  # Filtered values
-        cols = [row['Gene'].split(']')[0].strip('[') for row in rows] + ['condition']
-
-    # Load file
-    hm = pd.read_csv(f"{path}data/{hm_fn}", sep='\t', usecols=cols)
-    hm = hm[hm.columns[::-1]]  # Condition must be the first row
-
-    # Filter data
+        genes = filter_stat(stat, filters_used)['Gene'].tolist()
 
     # Get figure
-    fig = get_heatmap(hm)
+    fig = heatmap_figure(hm_fn, genes)
 
     return fig
 
 
+# Job progress in the upload info panel, refreshed while the job is running
+@app.callback(
+    Output('upload-info', 'children'),
+    Output('progress-interval', 'disabled'),
+    Input('url', 'href'),
+    Input('progress-interval', 'n_intervals'),
+)
+def upload_info_progress(href, n_intervals):
+    try:
+        job_token = furl(href).args["token"]
+    except KeyError:  # no token provided
+        raise PreventUpdate
+
+    job = job_store.job_info(job_token)
+    if not job:
+        raise PreventUpdate
+
+    filename, confirmed, start_time, end_time = job
+    running = False
+    if end_time is not None:
+        status = 'finished'
+    elif not confirmed:
+        status = 'waiting for confirmation in Telegram'
+    elif start_time is None:
+        status = 'waiting in the queue'
+    else:
+        running = True
+        try:
+            status = job_status(job_token, redis_conn) or 'running'
+        except RedisError:
+            status = 'running'
+
+    return [html.H5("Upload info"), html.Hr(), dcc.Markdown(f"**{filename}**: {status}")], not running
+
+
 # Callback for Info popup button
 @app.callback(
     Output("modal", "is_open"),
@@ -664,6 +920,9 @@ app.layout = html.Div(
         # represents the URL bar, doesn't render anything
         dcc.Location(id='url', refresh=True),
 
+        # refreshes the progress of a running job
+        dcc.Interval(id='progress-interval', interval=10000, disabled=True),
+
         # trigger for page_loaded bool - to distinguish between reset filters and page initial load
         html.Div(id='page_loaded', children=0, style=dict(display='none')),
 
@@ -671,6 +930,9 @@ app.layout = html.Div(
         html.Div(id='stat_fn', children="", style=dict(display='none')),
         html.Div(id='hm_fn', children="", style=dict(display='none')),
 
+        # ids of selected table rows, on all pages
+        dcc.Store(id='selected_ids', data=[]),
+
     ]
 )
 
@@ -0,0 +1,72 @@
+'''
+Elastic-net logistic regression for stability selection. One fit goes along a path of decreasing regularization,
+each point starts from the coefficients of the previous one (warm start), so the path costs a few cold fits.
+'''
+
+import warnings
+
+import numpy as np
+from scipy import sparse
+from sklearn.base import BaseEstimator
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import l1_min_c
+
+
+class ElasticNetPath(BaseEstimator):
+    '''
+    Elastic-net logistic regression fitted on a regularization path. Expressions are log1p-transformed and
+    scaled to unit variance (not centered for a sparse matrix, so it stays sparse).
+    feature_importances_ are absolute coefficients summed over classes and path points, normalized to 1:
+    genes entering the model at stronger regularization get higher importance.
+    Only the importances are used, so there is no predict().
+
+    Arguments:
+    - l1_ratio: elastic-net mixing parameter, 1 is lasso
+    - n_cs: number of points on the path
+    - path_span: ratio of the weakest to the strongest regularization on the path
+    - max_iter: maximal number of saga epochs at each point
+    - tol: saga stopping tolerance
+    - random_state: random state of saga
+    '''
+
+    def __init__(self, l1_ratio=0.5, n_cs=10, path_span=100., max_iter=200, tol=1e-3, random_state=None):
+        self.l1_ratio = l1_ratio
+        self.n_cs = n_cs
+        self.path_span = path_span
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        if sparse.issparse(X):
+            X = sparse.csr_matrix(X, dtype='float64', copy=True)
+            X.data = np.log1p(X.data)
+        else:
+            X = np.log1p(np.asarray(X, dtype='float64'))
+        X = StandardScaler(with_mean=not sparse.issparse(X)).fit_transform(X)
+
+        self.classes_ = np.unique(y)
+        self.feature_importances_ = np.zeros(X.shape[1])
+        try:
+            # All coefficients are zero at C <= c_min, the path starts right above it
+            c_min = self.l1_ratio * l1_min_c(X, y, loss='log')
+        except ValueError:  # all features are constant
+            return self
+        self.Cs_ = np.geomspace(c_min, c_min * self.path_span, self.n_cs + 1)[1:]
+
+        model = LogisticRegression(penalty='elasticnet', solver='saga', l1_ratio=self.l1_ratio, warm_start=True,
+                                   max_iter=self.max_iter, tol=self.tol, random_state=self.random_state)
+        with warnings.catch_warnings():
+            # Points of the path are only starting points for the next ones, they don't have to converge
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            for C in self.Cs_:
+                model.set_params(C=C).fit(X, y)
+                self.feature_importances_ += np.abs(model.coef_).sum(axis=0)
+
+        self.model_ = model
+        total = self.feature_importances_.sum()
+        if total:
+            self.feature_importances_ /= total
+        return self
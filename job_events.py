@@ -0,0 +1,48 @@
+import json
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+# Redis pub/sub channels the scheduler listens to
+CONFIRMED_CHANNEL = 'markerfinder:confirmed'
+FINISHED_CHANNEL = 'markerfinder:finished'
+
+_redis_conn = None
+
+
+def _connection():
+    global _redis_conn
+    if _redis_conn is None:
+        _redis_conn = Redis(host='localhost', port=6379, db=0)
+    return _redis_conn
+
+
+def publish_confirmed(job_token):
+    """
+    Wake the scheduler up after a job was confirmed in Telegram.
+    If Redis is not available, the job is picked up by the scheduler's periodic rescan.
+    :param str job_token:
+    :return:
+    """
+    try:
+        _connection().publish(CONFIRMED_CHANNEL, job_token)
+    except RedisError:
+        pass
+
+
+def on_job_success(job, connection, result, *args, **kwargs):
+    """
+    RQ success callback, runs in the worker. RQ calls it before the job status is set to finished,
+    so the outcome is sent in the message itself.
+    """
+    connection.publish(FINISHED_CHANNEL, json.dumps({'token': job.id, 'status': 'finished'}))
+
+
+def on_job_failure(job, connection, type, value, traceback):
+    """
+    RQ failure callback, runs in the worker. It's called before RQ decides whether to retry the job,
+    a job with retries left is going to be requeued and resumed from its checkpoints.
+    """
+    if job.retries_left:
+        return
+    connection.publish(FINISHED_CHANNEL, json.dumps({'token': job.id, 'status': 'failed'}))
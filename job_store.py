@@ -0,0 +1,237 @@
+'''
+Job store: access to the jobs db (tg/jobs.db) shared by the Dash app, the Telegram bot, the scheduler and RQ jobs.
+The db is in WAL mode, so readers don't block the writer and the other way around, and writers wait for each other
+(busy timeout) instead of failing with "database is locked". Connections are pooled per process and reused,
+the schema and indexes are created on the first connection.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+path = f'{os.path.abspath(os.curdir)}/'
+
+DB_FN = f"{path}tg/jobs.db"
+BUSY_TIMEOUT = 30.  # seconds a writer waits for another one
+POOL_SIZE = 8  # idle connections kept per process
+JOB_COLUMNS = ("id, job_confirmed, user_id, job_token, filename, user_filename, n_obs, start_time, end_time, "
+               "notification_sent")
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS "jobs" ("id" INTEGER NOT NULL UNIQUE, "job_confirmed" INTEGER NOT NULL DEFAULT 0, '
+    '"user_id" TEXT, "job_token" TEXT NOT NULL, "filename" INTEGER NOT NULL, "user_filename" INTEGER, '
+    '"n_obs" INTEGER NOT NULL, "start_time" INTEGER, "end_time" INTEGER, '
+    '"notification_sent" INTEGER NOT NULL DEFAULT 0, PRIMARY KEY("id" AUTOINCREMENT))',
+    "CREATE TABLE IF NOT EXISTS job_stages (job_token TEXT NOT NULL, stage TEXT NOT NULL, seconds REAL, "
+    "rows INTEGER, cols INTEGER, peak_rss_mb REAL, finished_at INTEGER)",
+    # jobs removed by retention (see retention.py), with the time and the reason
+    'CREATE TABLE IF NOT EXISTS "jobs_archive" ("id" INTEGER NOT NULL, "job_confirmed" INTEGER NOT NULL, '
+    '"user_id" TEXT, "job_token" TEXT NOT NULL, "filename" INTEGER NOT NULL, "user_filename" INTEGER, '
+    '"n_obs" INTEGER NOT NULL, "start_time" INTEGER, "end_time" INTEGER, "notification_sent" INTEGER NOT NULL, '
+    '"archived_at" INTEGER NOT NULL, "reason" TEXT)',
+    "CREATE INDEX IF NOT EXISTS jobs_token ON jobs (job_token)",
+    # pending (confirmed, not started) jobs
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (job_confirmed, start_time, end_time)",
+    # running (not finished, started) jobs and finished ones by age
+    "CREATE INDEX IF NOT EXISTS jobs_end ON jobs (end_time, start_time)",
+    "CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, end_time)",
+    "CREATE INDEX IF NOT EXISTS job_stages_token ON job_stages (job_token)",
+    "CREATE INDEX IF NOT EXISTS jobs_archive_token ON jobs_archive (job_token)",
+]
+
+_pool = []
+_pool_pid = None
+_pool_lock = threading.Lock()
+_initialized = set()
+
+
+def connect(db_fn=None):
+    '''
+    Function that opens a new connection to the jobs db in WAL mode.
+    Prefer transaction(), which reuses pooled connections.
+
+    Arguments:
+    - db_fn: jobs db, tg/jobs.db by default
+    '''
+    db_fn = db_fn or DB_FN
+    con = sqlite3.connect(db_fn, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")  # durable on commit in WAL mode except for a power loss
+    if db_fn not in _initialized:
+        with con:
+            for statement in SCHEMA:
+                con.execute(statement)
+        _initialized.add(db_fn)
+    return con
+
+
+def _take():
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():  # connections must not be shared with a forked parent (RQ work horse)
+            _pool.clear()
+            _pool_pid = os.getpid()
+        if _pool:
+            return _pool.pop()
+    return connect()
+
+
+def _give_back(con):
+    with _pool_lock:
+        if _pool_pid == os.getpid() and len(_pool) < POOL_SIZE:
+            _pool.append(con)
+            return
+    con.close()
+
+
+@contextmanager
+def transaction(write=False):
+    '''
+    Context manager that gives a pooled connection inside a transaction: committed at the end,
+    rolled back on an exception.
+
+    Arguments:
+    - write: take the write lock at the start, so the transaction can't fail on a lock upgrade after its reads
+    '''
+    con = _take()
+    try:
+        if write:
+            con.execute("BEGIN IMMEDIATE")
+        with con:
+            yield con
+    except sqlite3.Error:
+        con.close()  # may be in a broken state, e.g. a transaction left open
+        raise
+    except BaseException:
+        _give_back(con)
+        raise
+    else:
+        _give_back(con)
+
+
+def add_job(user_filename, filename, job_token, n_obs):
+    '''
+    Function that adds an unconfirmed job, it's confirmed later in Telegram.
+    '''
+    with transaction(write=True) as con:
+        con.execute("INSERT INTO jobs (user_filename, filename, job_token, n_obs) VALUES (?, ?, ?, ?)",
+                    (user_filename, filename, job_token, int(n_obs)))
+
+
+def confirm_job(job_token, user_id):
+    '''
+    Function that confirms a job and assigns it to a Telegram user.
+
+    Returns:
+    - The name of the uploaded file, or None if there is no such job
+    '''
+    with transaction(write=True) as con:
+        row = con.execute("SELECT user_filename FROM jobs WHERE job_token=?", (job_token,)).fetchone()
+        if row is None:
+            return None
+        con.execute("UPDATE jobs SET job_confirmed=1, user_id=? WHERE job_token=?", (user_id, job_token))
+    return row[0]
+
+
+def job_filename(job_token):
+    '''
+    Function that returns the file name of the job results, or None if there is no such job.
+    '''
+    with transaction() as con:
+        row = con.execute("SELECT filename FROM jobs WHERE job_token=?", (job_token,)).fetchone()
+    return row[0] if row else None
+
+
+def job_info(job_token):
+    '''
+    Returns:
+    - A tuple (user_filename, job_confirmed, start_time, end_time), or None if there is no such job
+    '''
+    with transaction() as con:
+        return con.execute("SELECT user_filename, job_confirmed, start_time, end_time FROM jobs WHERE job_token=?",
+                           (job_token,)).fetchone()
+
+
+def user_jobs(user_id):
+    '''
+    Returns:
+    - A list of (user_filename, job_token, start_time) of unfinished jobs of a user
+    '''
+    with transaction() as con:
+        return con.execute("SELECT user_filename, job_token, start_time FROM jobs WHERE user_id=? AND end_time IS NULL",
+                           (str(user_id),)).fetchall()
+
+
+def running_jobs():
+    '''
+    Returns:
+    - A list of (job_token, user_id) of started and not finished jobs
+    '''
+    with transaction() as con:
+        return con.execute("SELECT job_token, user_id FROM jobs "
+                           "WHERE start_time IS NOT NULL AND end_time IS NULL").fetchall()
+
+
+def pending_jobs():
+    '''
+    Returns:
+    - A list of (job_token, user_id, n_obs) of confirmed jobs that are not started, in the order of upload
+    '''
+    with transaction() as con:
+        return con.execute("SELECT job_token, user_id, n_obs FROM jobs "
+                           "WHERE job_confirmed=1 AND start_time IS NULL ORDER BY id").fetchall()
+
+
+def mark_started(job_tokens):
+    '''
+    Function that sets the start time of several jobs in one transaction.
+    '''
+    if not job_tokens:
+        return
+    now = int(time.time())
+    with transaction(write=True) as con:
+        con.executemany("UPDATE jobs SET start_time=? WHERE job_token=?", [(now, _token) for _token in job_tokens])
+
+
+def mark_finished(con, job_tokens):
+    '''
+    Function that sets the end time of several jobs, inside the caller's transaction.
+
+    Returns:
+    - A list of (job_token, user_id, filename) of the jobs that were not finished before
+    '''
+    now = int(time.time())
+    finished = []
+    for _token in job_tokens:
+        if con.execute("UPDATE jobs SET end_time=? WHERE job_token=? AND end_time IS NULL", (now, _token)).rowcount:
+            finished.append((_token, *con.execute("SELECT user_id, filename FROM jobs WHERE job_token=?",
+                                                  (_token,)).fetchone()))
+    return finished
+
+
+def save_stage(job_token, record):
+    '''
+    Function that records a finished stage of a job (see progress.stage).
+    '''
+    with transaction(write=True) as con:
+        con.execute("INSERT INTO job_stages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_token, record['stage'], record['seconds'], record.get('rows'), record.get('cols'),
+                     record['peak_rss_mb'], int(time.time())))
+
+
+def archive_jobs(con, job_ids, reason):
+    '''
+    Function that moves job rows into the jobs_archive table, inside the caller's transaction.
+
+    Arguments:
+    - con: jobs db connection
+    - job_ids: ids of the rows
+    - reason: why the jobs are archived, e.g. 'expired'
+    '''
+    now = int(time.time())
+    for _id in job_ids:
+        con.execute(f"INSERT INTO jobs_archive ({JOB_COLUMNS}, archived_at, reason) "
+                    f"SELECT {JOB_COLUMNS}, ?, ? FROM jobs WHERE id=?", (now, reason, _id))
+        con.execute("DELETE FROM jobs WHERE id=?", (_id,))
@@ -0,0 +1,178 @@
+'''
+Binary format for uploaded expression matrices. An upload is parsed once and stored as:
+- magic bytes and the length of a json header,
+- the json header: matrix shape, gene names, condition column name and values,
+- a float32 (samples, genes) matrix in C order, aligned to 64 bytes, so it can be memory-mapped.
+'''
+
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'MFEXPR1\n'
+ALIGN = 64
+EXTENSION = '.expr'
+
+
+def _write_header(f, n_samples, genes, condition, cond_col):
+    header = json.dumps({'shape': [n_samples, len(genes)],
+                         'genes': [str(gene) for gene in genes],
+                         'cond_col': cond_col,
+                         'condition': np.asarray(condition).tolist()}).encode()
+    padding = -(len(MAGIC) + 8 + len(header)) % ALIGN
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header) + padding))
+    f.write(header + b' ' * padding)
+
+
+def write_matrix(fn, matrix, genes, condition, cond_col='condition'):
+    '''
+    Function that writes an expression matrix to a binary file.
+
+    Arguments:
+    - fn: file name
+    - matrix: a (samples, genes) array with counts/pseudocounts of genes expressions
+    - genes: gene names, in the order of matrix columns
+    - condition: conditions of the samples
+    - cond_col: a name of the condition column
+    '''
+    matrix = np.ascontiguousarray(matrix, dtype='<f4')
+
+    # Written to a temporary file first, so that a reader never sees a partial matrix
+    tmp_fn = f'{fn}.{os.getpid()}.tmp'
+    with open(tmp_fn, 'wb') as f:
+        _write_header(f, matrix.shape[0], genes, condition, cond_col)
+        f.write(matrix.tobytes())
+    os.replace(tmp_fn, fn)
+
+
+def write_dataframe(fn, df, cond_col='condition'):
+    '''
+    Function that converts a parsed upload into the binary format.
+    Raises ValueError if there is no condition column or some of the genes are not numeric.
+
+    Arguments:
+    - fn: file name
+    - df: a dataframe with counts/pseudocounts of genes expressions and a condition column
+    - cond_col: a name of the condition column
+
+    Returns:
+    - The (samples, genes) shape of the matrix
+    '''
+    if cond_col not in df.columns:
+        raise ValueError(f'Column "{cond_col}" is missing')
+    expr = df.drop(columns=[cond_col])
+    matrix = expr.apply(pd.to_numeric).to_numpy(dtype='float32')
+    write_matrix(fn, matrix, expr.columns, df[cond_col].to_numpy(), cond_col)
+    return matrix.shape
+
+
+def convert_text(src_fn, fn, sep=',', cond_col='condition', chunksize=256):
+    '''
+    Function that converts a delimited text file into the binary format, reading it by chunks of rows,
+    so memory use does not depend on the number of samples.
+    Raises ValueError if there is no condition column, some of the genes are not numeric or chunks
+    have different columns.
+
+    Arguments:
+    - src_fn: text file name
+    - fn: binary file name
+    - sep: delimiter of the text file
+    - cond_col: a name of the condition column
+    - chunksize: number of rows (samples) parsed at once
+
+    Returns:
+    - The (samples, genes) shape of the matrix
+    '''
+    genes, condition = None, []
+    data_fn = f'{fn}.{os.getpid()}.data'
+    try:
+        with open(data_fn, 'wb') as data_f:
+            for chunk in pd.read_csv(src_fn, sep=sep, chunksize=chunksize):
+                if genes is None:
+                    if cond_col not in chunk.columns:
+                        raise ValueError(f'Column "{cond_col}" is missing')
+                    genes = chunk.columns.drop(cond_col)
+                elif not chunk.columns.drop(cond_col).equals(genes):
+                    raise ValueError('Rows have different columns')
+                condition.extend(chunk[cond_col].tolist())
+                data_f.write(np.ascontiguousarray(chunk[genes].apply(pd.to_numeric), dtype='<f4').tobytes())
+
+        if genes is None:
+            raise ValueError('File is empty')
+
+        tmp_fn = f'{fn}.{os.getpid()}.tmp'
+        with open(tmp_fn, 'wb') as f, open(data_fn, 'rb') as data_f:
+            _write_header(f, len(condition), genes, condition, cond_col)
+            shutil.copyfileobj(data_f, f)
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(data_fn):
+            os.remove(data_fn)
+
+    return len(condition), len(genes)
+
+
+def read_header(fn):
+    '''
+    Function that reads the header of a binary matrix file.
+
+    Arguments:
+    - fn: file name
+
+    Returns:
+    - A tuple (header dict, offset of the matrix in bytes)
+    '''
+    with open(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{fn} is not an expression matrix file')
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len))
+    return header, len(MAGIC) + 8 + header_len
+
+
+def read_matrix(fn, mmap=True):
+    '''
+    Function that reads a binary matrix file.
+
+    Arguments:
+    - fn: file name
+    - mmap: whether to memory-map the matrix (read-only) instead of loading it into memory
+
+    Returns:
+    - A tuple (float32 matrix, gene names, condition array, condition column name)
+    '''
+    header, offset = read_header(fn)
+    shape = tuple(header['shape'])
+    if mmap:
+        matrix = np.memmap(fn, dtype='<f4', mode='r', offset=offset, shape=shape)
+    else:
+        matrix = np.fromfile(fn, dtype='<f4', offset=offset).reshape(shape)
+    return matrix, header['genes'], np.asarray(header['condition']), header['cond_col']
+
+
+def read_dataframe(fn, columns=None, mmap=True):
+    '''
+    Function that reads a binary matrix file into a dataframe with genes and a condition column.
+
+    Arguments:
+    - fn: file name
+    - columns: genes (and the condition column) to read, all by default
+    - mmap: whether to memory-map the matrix instead of loading it into memory
+
+    Returns:
+    - A dataframe with counts/pseudocounts of genes expressions and a condition column
+    '''
+    matrix, genes, condition, cond_col = read_matrix(fn, mmap=mmap)
+    if columns is not None:
+        index = {gene: i for i, gene in enumerate(genes)}
+        genes = [col for col in columns if col != cond_col]
+        matrix = matrix[:, [index[gene] for gene in genes]]
+
+    df = pd.DataFrame(matrix, columns=genes, copy=False)
+    df[cond_col] = condition
+    return df
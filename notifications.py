@@ -0,0 +1,214 @@
+'''
+Outbox of Telegram notifications. The scheduler only writes a notification into the notifications table of the
+jobs db, in the same transaction that marks the job finished, so a slow or unavailable Telegram API never stalls
+job dispatch and no notification is lost if a process stops. The sender (python notifications.py) drains the
+outbox with asyncio: messages are sent in batches over one HTTP session, within the Bot API rate limits, and failed
+messages are retried with exponential backoff.
+'''
+
+import asyncio
+import random
+import re
+import time
+
+import aiohttp
+import toml
+
+import job_store
+
+API_URL = 'https://api.telegram.org'
+BATCH_SIZE = 30  # Bot API allows about 30 messages per second to different chats
+BATCH_INTERVAL = 1.  # seconds between batches, also the limit of one message per second to a chat
+POLL_INTERVAL = 2.  # seconds between outbox checks while it's empty
+RETRY_BASE = 5.  # seconds before the first retry, doubled with every attempt
+RETRY_MAX = 3600.
+MAX_ATTEMPTS = 34  # about a day of retries (1.4 h to reach RETRY_MAX, then hourly), then it's given up
+REQUEST_TIMEOUT = 30.
+
+
+def add_escape_chars(input_str) -> str:
+    """
+    Copied from telebot.formatiing.escape_markdown
+    """
+    parse = re.sub(r"([_*\[\]()~`>\#\+\-=|\.!\{\}])", r"\\\1", input_str)
+    reparse = re.sub(r"\\\\([_*\[\]()~`>\#\+\-=|\.!\{\}])", r"\1", parse)
+    return reparse
+
+
+def create_outbox(con):
+    con.execute("CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "job_token TEXT, chat_id TEXT NOT NULL, text TEXT NOT NULL, parse_mode TEXT, "
+                "created INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                "sent_at INTEGER, failed INTEGER NOT NULL DEFAULT 0, error TEXT)")
+    con.execute("CREATE INDEX IF NOT EXISTS notifications_pending ON notifications (next_attempt) "
+                "WHERE sent_at IS NULL AND failed=0")
+
+
+def enqueue(con, chat_id, text, parse_mode=None, job_token=None):
+    '''
+    Function that adds a message to the outbox. It isn't committed here, so it's saved together with the
+    caller's changes (e.g. the end of the job).
+
+    Arguments:
+    - con: jobs db connection
+    - chat_id: Telegram chat id
+    - text: message text
+    - parse_mode: Bot API parse mode, e.g. 'MarkdownV2'
+    - job_token: job the message is about, its notification_sent is set once the message is delivered
+    '''
+    create_outbox(con)
+    now = time.time()
+    con.execute("INSERT INTO notifications (job_token, chat_id, text, parse_mode, created, next_attempt) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (job_token, str(chat_id), text, parse_mode, int(now), now))
+
+
+def enqueue_job_finished(con, user_id, filename, job_token):
+    '''
+    Function that adds the notification about a finished job to the outbox.
+    '''
+    enqueue(con, user_id,
+            f'Calculations on {add_escape_chars(str(filename))} are complete\\!'
+            f'\nYou can now check the results by following the '
+            f'[link](http://127.0.0.1:8070/?token={job_token})',
+            parse_mode='MarkdownV2', job_token=job_token)
+
+
+def retry_delay(attempts):
+    '''
+    Exponential backoff with jitter, so messages failed together don't come back together.
+
+    Arguments:
+    - attempts: failed attempts so far
+    '''
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX) * random.uniform(0.8, 1.2)
+
+
+async def send_message(session, url, chat_id, text, parse_mode):
+    '''
+    Function that sends one message with the Bot API sendMessage method.
+
+    Returns:
+    - A tuple (status, retry_after, error): status is 'sent', 'retry' or 'failed' (rejected by Telegram,
+      e.g. the user blocked the bot), retry_after is the pause requested by Telegram (flood control)
+    '''
+    payload = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    try:
+        async with session.post(url, json=payload) as response:
+            try:
+                answer = await response.json(content_type=None)
+            except ValueError:
+                answer = {}
+            if response.status == 200 and answer.get('ok'):
+                return 'sent', None, None
+
+            error = f"{response.status}: {answer.get('description', response.reason)}"
+            if response.status == 429:
+                return 'retry', answer.get('parameters', {}).get('retry_after', RETRY_BASE), error
+            if 400 <= response.status < 500:
+                return 'failed', None, error
+            return 'retry', None, error
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return 'retry', None, f"{type(e).__name__}: {e}"
+
+
+def due_messages(con, now, limit):
+    '''
+    Messages to send now, the oldest first and at most one per chat (a chat accepts about one message per second).
+    '''
+    cur = con.execute("SELECT id, job_token, chat_id, text, parse_mode, attempts FROM notifications "
+                      "WHERE sent_at IS NULL AND failed=0 AND next_attempt<=? ORDER BY id", (now,))
+    batch, chats = [], set()
+    for row in cur:
+        if row[2] not in chats:
+            chats.add(row[2])
+            batch.append(row)
+            if len(batch) == limit:
+                break
+    return batch
+
+
+async def send_batch(session, con, url):
+    '''
+    Function that sends one batch of due messages concurrently and saves the outcomes in one transaction.
+
+    Returns:
+    - A tuple (number of messages in the batch, pause requested by Telegram in seconds or 0)
+    '''
+    batch = due_messages(con, time.time(), BATCH_SIZE)
+    if not batch:
+        return 0, 0
+
+    results = await asyncio.gather(*(send_message(session, url, chat_id, text, parse_mode)
+                                     for _id, job_token, chat_id, text, parse_mode, attempts in batch))
+
+    now = time.time()
+    pause = 0
+    with con:
+        for (_id, job_token, chat_id, text, parse_mode, attempts), (status, retry_after, error) in zip(batch, results):
+            if status == 'sent':
+                con.execute("UPDATE notifications SET sent_at=?, attempts=?, error=NULL WHERE id=?",
+                            (int(now), attempts + 1, _id))
+                if job_token:
+                    con.execute("UPDATE jobs SET notification_sent=1 WHERE job_token=?", (job_token,))
+                continue
+
+            attempts += 1
+            if status == 'failed' or attempts >= MAX_ATTEMPTS:
+                print(f"Notification {_id} to {chat_id} given up: {error}")
+                con.execute("UPDATE notifications SET attempts=?, failed=1, error=? WHERE id=?",
+                            (attempts, error, _id))
+                continue
+
+            delay = retry_delay(attempts)
+            if retry_after:  # flood control: the whole bot waits
+                pause = max(pause, retry_after)
+                delay = max(delay, retry_after)
+            con.execute("UPDATE notifications SET attempts=?, next_attempt=?, error=? WHERE id=?",
+                        (attempts, now + delay, error, _id))
+    return len(batch), pause
+
+
+async def run_sender(bot_token, api_url=API_URL, db_fn=None, stop=None):
+    '''
+    Function that drains the outbox until stop is set (forever by default).
+
+    Arguments:
+    - bot_token: Telegram bot token
+    - api_url: Bot API server, e.g. a local one
+    - db_fn: jobs db, tg/jobs.db by default
+    - stop: asyncio.Event that stops the sender once the outbox has no due messages
+    '''
+    url = f"{api_url.rstrip('/')}/bot{bot_token}/sendMessage"
+    con = job_store.connect(db_fn)
+    create_outbox(con)
+    con.commit()
+
+    # One session keeps connections to the API alive between batches
+    connector = aiohttp.TCPConnector(limit=BATCH_SIZE)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
+        try:
+            while True:
+                started = time.monotonic()
+                sent, pause = await send_batch(session, con, url)
+                if not sent and stop is not None and stop.is_set():
+                    break
+                if pause:
+                    print(f"Flood control, sending paused for {pause} s")
+                    await asyncio.sleep(pause)
+                elif sent:
+                    await asyncio.sleep(max(BATCH_INTERVAL - (time.monotonic() - started), 0))
+                else:
+                    await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            con.close()
+
+
+if __name__ == '__main__':
+    try:
+        tg_config = toml.load('config.toml').get('tg', {})
+    except FileNotFoundError:
+        tg_config = {}
+    asyncio.run(run_sender(tg_config.get('tg_token'), tg_config.get('api_url') or API_URL))
@@ -0,0 +1,197 @@
+'''
+Persistent cache of the model stage results: best XGBoost hyperparameters and per-iteration feature importances
+of every model. Entries are keyed by a content hash of the expression matrix, conditions and search (or model)
+settings, so a resubmission of the same data only re-thresholds the cached importances.
+An entry may also keep the hashes of the input genes and samples, so a resubmission with appended samples
+finds the entry of the previous run and starts from its hyperparameters.
+'''
+
+import hashlib
+import json
+import os
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+
+def dataset_fingerprint(matrix, labels, genes, settings):
+    '''
+    Function that computes a content hash of the input data and the search settings.
+
+    Arguments:
+    - matrix: a (samples, genes) array or sparse CSR matrix with counts/pseudocounts of genes expressions
+    - labels: an integer array with conditions of the samples
+    - genes: gene names, in the order of matrix columns
+    - settings: a json-serializable dict with the search space and mode
+
+    Returns:
+    - A hex string key
+    '''
+    digest = hashlib.sha256()
+    digest.update(str(matrix.shape).encode())
+    # Arrays are hashed through the buffer protocol, without a bytes copy of the matrix
+    if sparse.issparse(matrix):
+        # XGBoost treats zeros absent from a sparse matrix as missing, so it's a different dataset for the model
+        digest.update(b'csr')
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            digest.update(np.ascontiguousarray(array))
+    else:
+        digest.update(np.ascontiguousarray(matrix, dtype='float32'))
+    digest.update(np.ascontiguousarray(labels, dtype='int64').tobytes())
+    digest.update('\t'.join(map(str, genes)).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def dataset_key(genes, settings):
+    '''
+    Function that computes a hash of the input genes and the search settings, the same for all versions
+    of a dataset with appended samples.
+
+    Arguments:
+    - genes: gene names of the input, before filtering
+    - settings: a json-serializable dict with the search space and mode
+
+    Returns:
+    - A hex string key
+    '''
+    digest = hashlib.sha256()
+    digest.update('\t'.join(map(str, genes)).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def sample_hashes(matrix, labels):
+    '''
+    Function that computes content hashes of the samples: expressions of every row with its condition.
+
+    Arguments:
+    - matrix: a (samples, genes) float32 array with counts/pseudocounts of genes expressions of the input
+    - labels: conditions of the samples
+
+    Returns:
+    - An array of hex strings, one per sample
+    '''
+    labels = np.asarray(labels).astype(str)
+    hashes = []
+    for row, label in zip(matrix, labels):
+        digest = hashlib.sha1(label.encode())
+        digest.update(np.ascontiguousarray(row, dtype='float32'))
+        hashes.append(digest.hexdigest()[:16])
+    return np.array(hashes, dtype='<U16')
+
+
+def find_base(cache_dir, key, samples):
+    '''
+    Function that finds the entry of a previous run on a subset of the samples of the same dataset.
+
+    Arguments:
+    - cache_dir: cache directory
+    - key: a key from dataset_key()
+    - samples: sample hashes from sample_hashes()
+
+    Returns:
+    - A dict with the best params of the largest such run, or None
+    '''
+    samples = Counter(samples.tolist())
+    best, best_size, best_fn = None, 0, None
+    try:
+        entries = [entry.path for entry in os.scandir(cache_dir) if entry.name.endswith('.npz')]
+    except FileNotFoundError:
+        return None
+
+    for fn in entries:
+        try:
+            with np.load(fn) as entry:
+                if 'dataset_key' not in entry.files or str(entry['dataset_key']) != key:
+                    continue
+                base_samples = Counter(entry['samples'].tolist())
+                # Every sample of the previous run is in the new data (with at least as many duplicates)
+                size = sum(base_samples.values())
+                if base_samples - samples or size <= best_size:
+                    continue
+                best, best_size, best_fn = json.loads(str(entry['params'])), size, fn
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            continue
+
+    if best_fn is not None:
+        os.utime(best_fn)
+    return best
+
+
+def load(cache_dir, key):
+    '''
+    Function that reads a cache entry and marks it as recently used.
+
+    Arguments:
+    - cache_dir: cache directory
+    - key: a key from dataset_fingerprint()
+
+    Returns:
+    - A tuple (best params, (genes, iterations) importances array or None), or None if there is no entry
+    '''
+    fn = os.path.join(cache_dir, f'{key}.npz')
+    try:
+        with np.load(fn) as entry:
+            params = json.loads(str(entry['params']))
+            importances = entry['importances'] if entry['importances'].size else None
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        return None
+
+    os.utime(fn)  # eviction drops the least recently used entries first
+    return params, importances
+
+
+def save(cache_dir, key, params, importances=None, max_size=None, samples=None):
+    '''
+    Function that writes a cache entry, then evicts old entries if the cache is larger than max_size.
+
+    Arguments:
+    - cache_dir: cache directory
+    - key: a key from dataset_fingerprint()
+    - params: a dict with best hyperparameters
+    - importances: a (genes, iterations) array with genes importances
+    - max_size: cache size limit in bytes, no limit by default
+    - samples: a tuple (key from dataset_key(), hashes from sample_hashes()) of the input, for find_base()
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    params = {name: value.item() if isinstance(value, np.generic) else value for name, value in params.items()}
+    if importances is None:
+        importances = np.empty((0, 0))
+    extra = {'dataset_key': samples[0], 'samples': samples[1]} if samples is not None else {}
+
+    # Written to a temporary file first, so that concurrent jobs never read a partial entry
+    fn = os.path.join(cache_dir, f'{key}.npz')
+    tmp_fn = f'{fn}.{os.getpid()}.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.savez_compressed(f, params=json.dumps(params), importances=importances, **extra)
+    os.replace(tmp_fn, fn)
+
+    if max_size:
+        evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    '''
+    Function that removes the least recently used entries until the cache fits into max_size bytes.
+
+    Arguments:
+    - cache_dir: cache directory
+    - max_size: cache size limit in bytes
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for mtime, size, fn in entries)
+    for mtime, size, fn in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(fn)
+        except FileNotFoundError:  # removed by another job
+            pass
+        total -= size
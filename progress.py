@@ -0,0 +1,120 @@
+'''
+Progress and per-stage timing of MarkerFinder jobs. Inside an RQ job, the current stage and counters are kept
+in job.meta['progress'], and finished stages are appended to job.meta['stages'] and to the job_stages table
+of the jobs db. Outside of RQ (e.g. a test call of MarkerFinder) stages are only printed.
+'''
+
+import os
+import resource
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from rq import get_current_job
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+
+import job_store
+
+path = f'{os.path.abspath(os.curdir)}/'
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of the process and its finished children (e.g. stability selection workers), in MB.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024  # kilobytes on Linux
+
+
+def report(**fields):
+    '''
+    Function that updates the progress of the current RQ job.
+
+    Arguments:
+    - fields: progress fields to set, e.g. stage, fits_done, fits_total
+    '''
+    job = get_current_job()
+    if job is None:
+        return
+    job.meta.setdefault('progress', {}).update(fields, peak_rss_mb=round(peak_rss_mb(), 1), updated=time.time())
+    job.save_meta()
+
+
+def report_fits(done, total, started):
+    '''
+    Function that reports the number of finished fits of a stage and estimates the time left.
+
+    Arguments:
+    - done: number of finished fits
+    - total: total number of fits
+    - started: time.monotonic() at the start of the fits
+    '''
+    seconds_per_fit = (time.monotonic() - started) / done if done else None
+    report(fits_done=done, fits_total=total,
+           seconds_per_fit=round(seconds_per_fit, 2) if seconds_per_fit else None,
+           eta_seconds=round(seconds_per_fit * (total - done)) if seconds_per_fit else None)
+
+
+@contextmanager
+def stage(name, shape=None):
+    '''
+    Context manager that marks a pipeline stage: reports it as the current one and records its duration.
+
+    Arguments:
+    - name: stage name
+    - shape: (rows, cols) of the stage input
+    '''
+    started = time.monotonic()
+    info = {'rows': int(shape[0]), 'cols': int(shape[1])} if shape is not None else {}
+    report(stage=name, stage_started=time.time(), fits_done=None, fits_total=None, seconds_per_fit=None,
+           eta_seconds=None, **info)
+
+    yield
+
+    record = {'stage': name, 'seconds': round(time.monotonic() - started, 2),
+              'peak_rss_mb': round(peak_rss_mb(), 1), **info}
+    print(f"Stage {name}: {record['seconds']} s, peak RSS {record['peak_rss_mb']} MB")
+
+    job = get_current_job()
+    if job is None:
+        return
+    job.meta.setdefault('stages', []).append(record)
+    job.save_meta()
+    try:
+        job_store.save_stage(job.id, record)
+    except sqlite3.Error:  # metrics must never fail the job
+        pass
+
+
+def job_status(job_token, redis_conn):
+    '''
+    Function that describes the state of a job for users.
+
+    Arguments:
+    - job_token: job token (RQ job id)
+    - redis_conn: Redis connection
+
+    Returns:
+    - A short text, or None if the job is not in RQ
+    '''
+    try:
+        job = Job.fetch(job_token, connection=redis_conn)
+    except NoSuchJobError:
+        return None
+
+    status = job.get_status()
+    if status in ('queued', 'deferred', 'scheduled'):
+        return 'waiting in the queue'
+    if status != 'started':
+        return status
+
+    job.refresh()
+    progress = job.meta.get('progress', {})
+    text = f"stage: {progress.get('stage', 'starting')}"
+    if progress.get('fits_total'):
+        text += f", {progress['fits_done']}/{progress['fits_total']} fits"
+    if progress.get('eta_seconds') is not None:
+        text += f", about {max(progress['eta_seconds'] // 60, 1)} min left in this stage"
+    return text
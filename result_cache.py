@@ -0,0 +1,128 @@
+"""
+Cache of parsed job results for the dashboard. A job's stat table and heatmap matrix are parsed once per process
+and kept until their files change or the cache needs room for other jobs.
+The heatmap matrix is also written next to the text file in the binary matrix format (see matrix_io) and
+memory-mapped, so other dashboard processes map the same pages instead of parsing the text again.
+"""
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+import artifacts
+import matrix_io
+
+MAX_BYTES = 512 * 2 ** 20  # parsed results kept per process
+
+_entries = OrderedDict()  # (data dir, job file name) -> (files signature, entry, size in bytes)
+_lock = Lock()
+_total = 0
+
+
+class JobResults:
+    """
+    Parsed results of a job
+    :param pd.DataFrame stat: stat table
+    :param list genes: heatmap genes, in the order of the heatmap file
+    :param np.ndarray condition: conditions of the heatmap samples
+    :param np.ndarray matrix: (samples, genes) float32 heatmap matrix, may be memory-mapped
+    """
+
+    def __init__(self, stat, genes, condition, matrix):
+        self.stat = stat
+        self.genes = genes
+        self.condition = condition
+        self.matrix = matrix
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+
+    def nbytes(self):
+        return int(self.stat.memory_usage(deep=True).sum()) + self.matrix.nbytes + self.condition.nbytes
+
+    def gene_frame(self, gene):
+        """
+        Expressions of one gene with conditions
+        :param str gene:
+        :return: pd.DataFrame with gene and 'condition' columns
+        """
+        return pd.DataFrame({gene: self.matrix[:, self.gene_index[gene]], 'condition': self.condition})
+
+    def heatmap_frame(self, genes=None):
+        """
+        Heatmap dataset in the dashboard layout: "condition" is the first column, genes follow in reverse file order
+        :param genes: genes to include, all by default
+        :return: pd.DataFrame
+        """
+        if genes is None:
+            index = np.arange(len(self.genes))
+        else:
+            index = np.sort(np.array([self.gene_index[gene] for gene in genes], dtype=np.intp))
+        if not len(index):  # e.g. the table filter matched nothing
+            return pd.DataFrame({'condition': self.condition})
+        index = index[::-1]
+        hm = pd.DataFrame(self.matrix[:, index], columns=[self.genes[i] for i in index])
+        hm.insert(0, 'condition', self.condition)
+        return hm
+
+
+def _signature(*fns):
+    return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, fns))
+
+
+def _load_heatmap(hm_fn):
+    """
+    Read the binary copy of the heatmap file if it's up to date, otherwise parse the text and write the copy
+    :param str hm_fn: heatmap text file, may be gzip-compressed
+    :return: (genes, condition, matrix)
+    """
+    expr_fn = f"{hm_fn.removesuffix(artifacts.GZIP_SUFFIX).removesuffix('.txt')}{matrix_io.EXTENSION}"
+    try:
+        if os.stat(expr_fn).st_mtime_ns >= os.stat(hm_fn).st_mtime_ns:
+            matrix, genes, condition, cond_col = matrix_io.read_matrix(expr_fn)
+            return genes, condition, matrix
+    except (OSError, ValueError):  # no copy yet or a broken one
+        pass
+
+    hm = pd.read_csv(hm_fn, sep='\t')
+    condition = hm.pop('condition').to_numpy()
+    genes = hm.columns.tolist()
+    matrix = hm.to_numpy(dtype='float32')
+    try:
+        matrix_io.write_matrix(expr_fn, matrix, genes, condition)
+    except OSError:  # read-only data dir, every process keeps its own copy
+        pass
+    return genes, condition, matrix
+
+
+def load(data_dir, fn):
+    """
+    Parsed results of a job, from the cache if its files didn't change
+    :param str data_dir: directory with job files
+    :param str fn: job file name, results are in {fn}_stat.txt and {fn}_hm.txt or their compressed copies
+    :return: JobResults
+    """
+    global _total
+    stat_fn, hm_fn = artifacts.resolve(f"{data_dir}{fn}_stat.txt"), artifacts.resolve(f"{data_dir}{fn}_hm.txt")
+    key, signature = (data_dir, fn), _signature(stat_fn, hm_fn)
+
+    with _lock:
+        cached = _entries.get(key)
+        if cached and cached[0] == signature:
+            _entries.move_to_end(key)
+            return cached[1]
+
+    # Parsed outside of the lock, so other jobs are served meanwhile
+    genes, condition, matrix = _load_heatmap(hm_fn)
+    entry = JobResults(pd.read_csv(stat_fn, sep='\t'), genes, condition, matrix)
+    size = entry.nbytes()
+
+    with _lock:
+        if key in _entries:
+            _total -= _entries.pop(key)[2]
+        _entries[key] = (signature, entry, size)
+        _total += size
+        while _total > MAX_BYTES and len(_entries) > 1:  # the least recently used first
+            _total -= _entries.popitem(last=False)[1][2]
+    return entry
@@ -0,0 +1,282 @@
+'''
+Retention of job files and rows (python retention.py, settings in the [retention] section of config.toml).
+Every run removes:
+- uploads never confirmed in Telegram, with their rows, after unconfirmed_days,
+- inputs of finished jobs after input_days,
+- results of finished jobs after results_days, the rows are moved to the jobs_archive table,
+- the oldest finished jobs of a user whose files take more than user_quota_mb,
+- binary heatmap copies of the dashboard (recreated on demand) after heatmap_copy_days,
+- checkpoints left by failed jobs after checkpoint_days,
+- delivered or given up notifications after notification_days,
+- blobs of the artifact store that no job file links to anymore.
+Queued and running jobs are never touched. Rows are archived before their files are removed, so the dashboard and
+the bot see either a complete job or no job; readers that opened a file before keep reading it (POSIX unlink).
+A TTL or quota of 0 keeps the files forever.
+'''
+
+import os
+import shutil
+import sqlite3
+import time
+
+import toml
+
+import artifacts
+import job_store
+import matrix_io
+
+path = f'{os.path.abspath(os.curdir)}/'
+
+DAY = 24 * 60 * 60
+DEFAULTS = {
+    'interval': 3600,
+    'unconfirmed_days': 2,
+    'input_days': 30,
+    'results_days': 90,
+    'user_quota_mb': 0,
+    'heatmap_copy_days': 7,
+    'checkpoint_days': 14,
+    'notification_days': 30,
+}
+
+
+def input_files(data_dir, job_token):
+    return [f"{data_dir}{job_token}{matrix_io.EXTENSION}", f"{data_dir}{job_token}.csv",
+            f"{data_dir}{job_token}.upload"]
+
+
+def result_files(data_dir, fn):
+    return [f"{data_dir}{fn}{suffix}{compressed}"
+            for suffix in ('_stat.txt', '_hm.txt') for compressed in ('', artifacts.GZIP_SUFFIX)] + \
+           [f"{data_dir}{fn}_hm{matrix_io.EXTENSION}"]
+
+
+def checkpoint_dir(data_dir, job_token):
+    return f"{data_dir}{job_token}_checkpoints"
+
+
+def files_size(fns):
+    size = 0
+    for fn in fns:
+        try:
+            size += os.stat(fn).st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def remove_files(fns):
+    '''
+    Function that removes files and directories, missing ones are skipped.
+
+    Returns:
+    - The number of removed files and directories
+    '''
+    removed = 0
+    for fn in fns:
+        try:
+            if os.path.isdir(fn):
+                shutil.rmtree(fn)
+            else:
+                os.remove(fn)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def job_files(data_dir, job_token, fn):
+    return input_files(data_dir, job_token) + result_files(data_dir, fn) + [checkpoint_dir(data_dir, job_token)]
+
+
+def upload_time(job_token):
+    '''
+    Time of the upload from the job token (see dash_app.create_link_to_telegram). The input file can't be used:
+    an identical upload is a link to the blob of an older one (see artifacts.put) and has its modification time.
+
+    Returns:
+    - The time in seconds, or None for a token without a time
+    '''
+    try:
+        return int(job_token.rsplit('_', 1)[1]) / 1e9
+    except (IndexError, ValueError):
+        return None
+
+
+def archive_and_remove(data_dir, jobs, condition, reason):
+    '''
+    Function that archives job rows that still match condition and then removes their files.
+
+    Arguments:
+    - data_dir: directory with job files
+    - jobs: (id, job_token, filename) of the jobs
+    - condition: SQL condition on the row, checked again inside the write transaction
+    - reason: archive reason
+
+    Returns:
+    - The number of archived jobs
+    '''
+    if not jobs:
+        return 0
+    with job_store.transaction(write=True) as con:
+        jobs = [job for job in jobs if con.execute(f"SELECT 1 FROM jobs WHERE id=? AND {condition}",
+                                                   (job[0],)).fetchone()]
+        job_store.archive_jobs(con, [job[0] for job in jobs], reason)
+
+    for _id, job_token, fn in jobs:
+        remove_files(job_files(data_dir, job_token, fn))
+    return len(jobs)
+
+
+def expire_unconfirmed(data_dir, ttl, now):
+    with job_store.transaction() as con:
+        rows = con.execute("SELECT id, job_token, filename FROM jobs WHERE job_confirmed=0").fetchall()
+    expired = []
+    for row in rows:
+        uploaded = upload_time(row[1])
+        if uploaded is not None and uploaded < now - ttl:
+            expired.append(row)
+    return archive_and_remove(data_dir, expired, "job_confirmed=0", 'unconfirmed')
+
+
+def expire_results(data_dir, ttl, now):
+    with job_store.transaction() as con:
+        rows = con.execute("SELECT id, job_token, filename FROM jobs WHERE end_time<?", (now - ttl,)).fetchall()
+    return archive_and_remove(data_dir, rows, "end_time IS NOT NULL", 'expired')
+
+
+def expire_inputs(data_dir, ttl, now):
+    with job_store.transaction() as con:
+        rows = con.execute("SELECT job_token FROM jobs WHERE end_time<?", (now - ttl,)).fetchall()
+    return sum(remove_files(input_files(data_dir, job_token)) for job_token, in rows)
+
+
+def enforce_quotas(data_dir, quota):
+    '''
+    Function that removes the oldest finished jobs of users whose jobs take more than quota bytes.
+    Queued and running jobs count towards the quota, but only finished ones are removed.
+
+    Returns:
+    - The number of removed jobs
+    '''
+    with job_store.transaction() as con:
+        rows = con.execute("SELECT id, job_token, filename, user_id, end_time FROM jobs WHERE user_id IS NOT NULL "
+                           "ORDER BY end_time IS NULL, end_time").fetchall()
+    users = {}
+    for _id, job_token, fn, user_id, end_time in rows:
+        users.setdefault(user_id, []).append((_id, job_token, fn, end_time,
+                                              files_size(job_files(data_dir, job_token, fn))))
+
+    over = []
+    for user_id, jobs in users.items():
+        total = sum(job[4] for job in jobs)
+        for _id, job_token, fn, end_time, size in jobs:  # finished ones first, the oldest first
+            if total <= quota or end_time is None:
+                break
+            over.append((_id, job_token, fn))
+            total -= size
+    return archive_and_remove(data_dir, over, "end_time IS NOT NULL", 'quota')
+
+
+def expire_heatmap_copies(data_dir, ttl, now):
+    fns = [entry.path for entry in os.scandir(data_dir)
+           if entry.name.endswith(f"_hm{matrix_io.EXTENSION}") and entry.stat().st_mtime < now - ttl]
+    return remove_files(fns)
+
+
+def expire_checkpoints(data_dir, ttl, now):
+    '''
+    Function that removes old checkpoints of failed jobs. Checkpoints of unfinished jobs are kept,
+    they may be retried.
+    '''
+    removed = 0
+    for entry in os.scandir(data_dir):
+        if not entry.name.endswith('_checkpoints') or entry.stat().st_mtime >= now - ttl:
+            continue
+        with job_store.transaction() as con:
+            unfinished = con.execute("SELECT 1 FROM jobs WHERE job_token=? AND end_time IS NULL",
+                                     (entry.name.removesuffix('_checkpoints'),)).fetchone()
+        if not unfinished:
+            removed += remove_files([entry.path])
+    return removed
+
+
+def expire_notifications(ttl, now):
+    with job_store.transaction(write=True) as con:
+        try:
+            return con.execute("DELETE FROM notifications WHERE (sent_at IS NOT NULL OR failed=1) AND created<?",
+                               (now - ttl,)).rowcount
+        except sqlite3.OperationalError:  # no outbox yet
+            return 0
+
+
+def collect_blobs(data_dir):
+    '''
+    Function that removes blobs of the artifact store which are not linked to by any job file.
+    A blob linked again at the same time keeps its content in the new link.
+
+    Returns:
+    - A tuple (removed blobs, freed bytes)
+    '''
+    removed, freed = 0, 0
+    store_dir = os.path.join(data_dir, artifacts.STORE_DIR)
+    if not os.path.isdir(store_dir):
+        return removed, freed
+    for prefix in os.scandir(store_dir):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            stat = entry.stat()
+            if stat.st_nlink == 1:
+                removed += remove_files([entry.path])
+                freed += stat.st_size
+    return removed, freed
+
+
+def run_once(data_dir, settings, now=None):
+    '''
+    Function that applies the retention settings once.
+
+    Arguments:
+    - data_dir: directory with job files
+    - settings: retention settings, see DEFAULTS
+    - now: current time, for tests
+
+    Returns:
+    - A dict with the numbers of removed items
+    '''
+    settings = {**DEFAULTS, **settings}
+    now = time.time() if now is None else now
+    report = {}
+    if settings['unconfirmed_days']:
+        report['unconfirmed_jobs'] = expire_unconfirmed(data_dir, settings['unconfirmed_days'] * DAY, now)
+    if settings['results_days']:
+        report['expired_jobs'] = expire_results(data_dir, settings['results_days'] * DAY, now)
+    if settings['input_days']:
+        report['inputs'] = expire_inputs(data_dir, settings['input_days'] * DAY, now)
+    if settings['user_quota_mb']:
+        report['quota_jobs'] = enforce_quotas(data_dir, settings['user_quota_mb'] * 2 ** 20)
+    if settings['heatmap_copy_days']:
+        report['heatmap_copies'] = expire_heatmap_copies(data_dir, settings['heatmap_copy_days'] * DAY, now)
+    if settings['checkpoint_days']:
+        report['checkpoints'] = expire_checkpoints(data_dir, settings['checkpoint_days'] * DAY, now)
+    if settings['notification_days']:
+        report['notifications'] = expire_notifications(settings['notification_days'] * DAY, now)
+    report['blobs'], report['freed_mb'] = collect_blobs(data_dir)
+    report['freed_mb'] = round(report['freed_mb'] / 2 ** 20, 1)
+    return report
+
+
+if __name__ == '__main__':
+    try:
+        retention_config = toml.load('config.toml').get('retention', {})
+    except FileNotFoundError:
+        retention_config = {}
+    settings = {**DEFAULTS, **retention_config}
+
+    while True:
+        try:
+            print(f"Retention: {run_once(f'{path}data/', settings)}")
+        except (OSError, sqlite3.Error) as e:  # e.g. the db is busy for too long, the next run catches up
+            print(f"Retention run failed: {e}")
+        time.sleep(settings['interval'])
@@ -1,91 +1,220 @@
+import json
 import os
-import sqlite3
+import toml
 
 from redis import Redis
-from rq import Worker, Queue, Connection
+from rq import Worker, Queue, Connection, Retry
 from rq.job import Job
-from time import time
-
-from copy import deepcopy
+from rq.exceptions import NoSuchJobError
 
 from multiprocessing import Process
 
 
-from tg_bot import launch_bot, send_notification
+from tg_bot import launch_bot
 
 
 from Main import MarkerFinder
+import job_store
+import matrix_io
+from job_events import CONFIRMED_CHANNEL, FINISHED_CHANNEL, on_job_success, on_job_failure
+from notifications import enqueue_job_finished
 
 
 
 
 path = f'{os.path.abspath(os.curdir)}/'
 
-
-def main_loop(redis_conn, r_queue):
-    with sqlite3.connect(f"{path}tg/jobs.db") as con:
-        cur_jobs = set()
-        j2t = {'a':'D4S0ze0DLmGda1qILCDUdA_16941326687502'}
-        while True:
-            cur = con.cursor()
-            cur.execute(
-                "SELECT job_confirmed, job_token, filename, n_obs, start_time FROM jobs WHERE job_confirmed=1 AND START_TIME IS NULL;")
-            table = cur.fetchall()
-            for row in table:
-                _token = row[1]
-                _time = int(time())
-                job = r_queue.enqueue(MarkerFinder,
-                                      f"./data/{_token}.csv",
-                                      "condition",
-                                      50,
-                                      float(row[3]),
-                                      100,
-                                      f"./data/{_token}_stat.txt",
-                                      f"./data/{_token}_hm.txt",
-                                      job_timeout=200000)
-                cur_jobs.add(job.id)
-                j2t[job.id]=_token
-                cur.execute("UPDATE jobs SET start_time=? WHERE job_token=?", (_time, _token))
-                con.commit()
-            cur_jobs_copy = deepcopy(cur_jobs)
-            for job_id in cur_jobs_copy:
-                # Get the job by its ID (use the job ID printed in enqueue_job.py)
-                job = Job.fetch(str(job_id), connection=redis_conn)
-                _token = j2t[job_id]
-                flag = True
-                # Check the job status
-                if job.is_finished:
-                    result = job.return_value()  # Get the result of the finished job
-                    print(f"Job Result: {result}")
-                elif job.is_failed:
-                    print("Job failed")
-                else:
-                    flag = False
-                if not flag:
-                    continue
-                cur_jobs.remove(job_id)
-                cur.execute("UPDATE jobs SET end_time=? WHERE job_token=?",
-                            (int(time()), _token,))
-                cur.execute("UPDATE jobs SET notification_sent=1 WHERE job_token=?",
-                            (_token,))
-
-                con.commit()
-                # sending only one message at a time, may proof with ORDER BY id DESC LIMIT 1
-                cur.execute("SELECT user_id, filename FROM jobs WHERE job_token=?",
-                            (_token,))
-                user_id, filename = cur.fetchone()
-                send_notification(user_id, filename, _token)
-
-
+RESCAN_INTERVAL = 60  # seconds without events before the db is checked anyway
+
+try:
+    config = toml.load('config.toml')
+except FileNotFoundError:
+    config = {}
+worker_config = config.get('worker', {})
+
+# Size classes of jobs: cost (samples x genes) limit and number of jobs of the class running at once
+queues_config = config.get('queues') or {'default': {'concurrency': 0}}
+
+_job_costs = {}
+
+
+def job_threads():
+    """
+    Thread budget of one MarkerFinder job: either set explicitly or all cores split between the jobs sharing a host
+    :return:
+    """
+    threads = worker_config.get('threads', 0)
+    if not threads:
+        threads = max(os.cpu_count() // max(worker_config.get('jobs_per_host', 1), 1), 1)
+    return threads
+
+
+def job_cost(_token):
+    """
+    Job cost estimate: samples x genes from the header of the uploaded matrix
+    :param str _token:
+    :return:
+    """
+    if _token not in _job_costs:
+        try:
+            header, offset = matrix_io.read_header(f"./data/{_token}{matrix_io.EXTENSION}")
+            _job_costs[_token] = header['shape'][0] * header['shape'][1]
+        except (FileNotFoundError, ValueError):  # uploaded as text before the binary format
+            _job_costs[_token] = float('inf')
+    return _job_costs[_token]
+
+
+def make_queues(redis_conn):
+    """
+    RQ queues for job size classes, from the smallest to the largest
+    :return: list of (queue, max_cost, concurrency), concurrency 0 means no limit
+    """
+    queues = []
+    for name, settings in queues_config.items():
+        queues.append((Queue(f"markerfinder-{name}", connection=redis_conn),
+                       settings.get('max_cost', float('inf')),
+                       settings.get('concurrency', 0)))
+    return sorted(queues, key=lambda q: q[1])
+
+
+def queue_index(queues, cost):
+    return next((i for i, (r_queue, max_cost, concurrency) in enumerate(queues) if cost <= max_cost), len(queues) - 1)
+
+
+def enqueue_job(r_queue, _token, n_obs):
+    """
+    Enqueue MarkerFinder job. The job token is used as RQ job id.
+    Failed jobs are retried and resume from the checkpoints of completed stages.
+    """
+    data_fn = f"./data/{_token}{matrix_io.EXTENSION}"
+    if not os.path.exists(data_fn):  # uploaded as text before the binary format
+        data_fn = f"./data/{_token}.csv"
+    r_queue.enqueue(MarkerFinder,
+                    data_fn,
+                    "condition",
+                    50,
+                    float(n_obs),
+                    100,
+                    f"./data/{_token}_stat.txt",
+                    f"./data/{_token}_hm.txt",
+                    job_threads(),
+                    worker_config.get('search', 'bayes'),
+                    worker_config.get('search_time_budget') or None,
+                    worker_config.get('search_max_evals') or None,
+                    worker_config.get('cache_dir') or None,
+                    worker_config.get('cache_size_mb', 0) * 2 ** 20 or None,
+                    f"./data/{_token}_checkpoints",
+                    worker_config.get('low_memory', False),
+                    tuple(worker_config.get('models', ['xgb'])),
+                    worker_config.get('enet_l1_ratio', 0.5),
+                    worker_config.get('incremental', True),
+                    worker_config.get('compress_results', True),
+                    job_id=_token,
+                    retry=Retry(max=worker_config.get('retries', 2)) if worker_config.get('retries', 2) else None,
+                    on_success=on_job_success,
+                    on_failure=on_job_failure,
+                    job_timeout=200000)
+
+
+def enqueue_confirmed(queues):
+    """
+    Move confirmed jobs into the queues of their size class while the class has free slots.
+    Jobs wait in the db otherwise. Free slots go to the users with the fewest running jobs of the class
+    (fair share), then in the order of confirmation. Start times are saved in one transaction.
+    """
+    running = [[] for _ in queues]
+    for _token, user_id in job_store.running_jobs():
+        running[queue_index(queues, job_cost(_token))].append(user_id)
+
+    pending = [[] for _ in queues]
+    for row in job_store.pending_jobs():
+        pending[queue_index(queues, job_cost(row[0]))].append(row)
+
+    started = []
+    try:
+        for (r_queue, max_cost, concurrency), class_running, class_pending in zip(queues, running, pending):
+            while class_pending and (not concurrency or len(class_running) < concurrency):
+                # min() keeps the first of equal elements, i.e. the earliest job
+                row = min(class_pending, key=lambda row: class_running.count(row[1]))
+                class_pending.remove(row)
+                _token, user_id, n_obs = row
+
+                enqueue_job(r_queue, _token, n_obs)
+                class_running.append(user_id)
+                started.append(_token)
+    finally:  # the jobs enqueued before an error are started too
+        job_store.mark_started(started)
+
+
+def finish_jobs(events):
+    """
+    Mark jobs as finished and notify the users, all in one transaction. Notifications go to the outbox,
+    they're sent by the notification sender (see notifications.py), so the Telegram API never blocks the scheduler.
+    :param list events: (job token, 'finished' or 'failed')
+    :return:
+    """
+    if not events:
+        return
+    statuses = dict(events)
+    with job_store.transaction(write=True) as con:
+        # jobs already handled, e.g. by a rescan, are skipped
+        for _token, user_id, filename in job_store.mark_finished(con, list(statuses)):
+            print(f"Job {_token} {statuses[_token]}")
+            enqueue_job_finished(con, user_id, filename, _token)
+
+
+def check_running(redis_conn):
+    """
+    Check the status of all started jobs in RQ. Catches the events missed while the scheduler was down.
+    """
+    events = []
+    for _token, user_id in job_store.running_jobs():
+        try:
+            job = Job.fetch(_token, connection=redis_conn)
+        except NoSuchJobError:  # expired or enqueued before tokens were used as job ids
+            events.append((_token, 'failed'))
+            continue
+        if job.is_finished:
+            events.append((_token, 'finished'))
+        elif job.is_failed:
+            events.append((_token, 'failed'))
+    finish_jobs(events)
+
+
+def main_loop(redis_conn, queues):
+    """
+    Waits for events instead of polling: job confirmations from the Telegram bot and job completion
+    callbacks from RQ workers. Events that came in together are handled in one batch.
+    The db is rescanned on start and when no events come for RESCAN_INTERVAL seconds.
+    """
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CONFIRMED_CHANNEL, FINISHED_CHANNEL)
+
+    check_running(redis_conn)
+    enqueue_confirmed(queues)
+    while True:
+        message = pubsub.get_message(timeout=RESCAN_INTERVAL)
+        if message is None:
+            check_running(redis_conn)
+        else:
+            finished = []
+            while message is not None:
+                if message['channel'].decode() == FINISHED_CHANNEL:
+                    event = json.loads(message['data'])
+                    finished.append((event['token'], event['status']))
+                message = pubsub.get_message(timeout=0)
+            finish_jobs(finished)
+        # a confirmed job or a freed slot
+        enqueue_confirmed(queues)
 
 
 if __name__ == '__main__':
     # Timer(1, open_browser).start()
     redis_conn = Redis(host='localhost', port=6379, db=0)
-    # Create a worker for the "default" queue with the specified connection
-    queue = Queue(connection=redis_conn)
+    # Queues for job size classes, workers should listen to them in the same order (rq worker markerfinder-small ...)
+    queues = make_queues(redis_conn)
     # p1 = Process(target=launch_bot)
     # p1.start()
     ping_response = redis_conn.ping()
     print(f"Redis Ping Response: {ping_response}")
-    main_loop(redis_conn, queue)
+    main_loop(redis_conn, queues)
@@ -0,0 +1,178 @@
+'''
+Tests of the notification sender against a stub Bot API server.
+'''
+
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import job_store
+import notifications
+
+TOKEN = '1:x'
+
+
+class StubBotApi:
+    '''
+    sendMessage answers by chat id: '429' is flood-controlled once, '502' fails with a bad gateway twice,
+    '403' is always rejected (the user blocked the bot), 'down' always fails with a bad gateway, others are sent.
+    '''
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, request):
+        chat_id = (await request.json())['chat_id']
+        self.calls.append(chat_id)
+        n_calls = self.calls.count(chat_id)
+        if chat_id == '429' and n_calls == 1:
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                      'parameters': {'retry_after': 7}}, status=429)
+        if chat_id == '502' and n_calls <= 2 or chat_id == 'down':
+            return web.Response(status=502, text='Bad Gateway')
+        if chat_id == '403':
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': 'Forbidden: bot was blocked by the user'}, status=403)
+        return web.json_response({'ok': True, 'result': {}})
+
+
+@pytest.fixture
+def con(tmp_path):
+    con = job_store.connect(str(tmp_path / 'jobs.db'))
+    notifications.create_outbox(con)
+    yield con
+    con.close()
+
+
+def add_notification(con, chat_id):
+    job_token = f'token_{chat_id}'
+    con.execute("INSERT INTO jobs (job_token, filename, n_obs, job_confirmed, user_id) VALUES (?, ?, 1, 1, ?)",
+                (job_token, f'{job_token}.csv', chat_id))
+    notifications.enqueue_job_finished(con, chat_id, 'file_1.csv', job_token)
+    con.commit()
+
+
+def notification(con, chat_id):
+    return con.execute("SELECT attempts, next_attempt, sent_at, failed, error FROM notifications WHERE chat_id=?",
+                       (chat_id,)).fetchone()
+
+
+def send_batches(con, n_batches, make_due=True, stub=None):
+    '''
+    Runs send_batch against the stub server, moving retries to now between batches.
+
+    Returns:
+    - The stub server and the list of send_batch results
+    '''
+    stub = stub or StubBotApi()
+
+    async def run():
+        app = web.Application()
+        app.router.add_post(f'/bot{TOKEN}/sendMessage', stub.send_message)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = f'http://127.0.0.1:{port}/bot{TOKEN}/sendMessage'
+        results = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for _ in range(n_batches):
+                    results.append(await notifications.send_batch(session, con, url))
+                    if make_due:
+                        with con:
+                            con.execute("UPDATE notifications SET next_attempt=0 WHERE sent_at IS NULL")
+        finally:
+            await runner.cleanup()
+        return results
+
+    return stub, asyncio.run(run())
+
+
+def test_sent(con):
+    add_notification(con, '1')
+    stub, results = send_batches(con, 1)
+
+    assert stub.calls == ['1']
+    assert results == [(1, 0)]
+    attempts, _, sent_at, failed, error = notification(con, '1')
+    assert (attempts, failed, error) == (1, 0, None)
+    assert sent_at is not None
+    assert con.execute("SELECT notification_sent FROM jobs WHERE job_token='token_1'").fetchone() == (1,)
+
+
+def test_retry_server_error(con):
+    add_notification(con, '502')
+    stub, results = send_batches(con, 3)
+
+    assert stub.calls == ['502'] * 3
+    attempts, _, sent_at, failed, error = notification(con, '502')
+    assert (attempts, failed, error) == (3, 0, None)
+    assert sent_at is not None
+
+
+def test_retry_backoff(con):
+    add_notification(con, '502')
+    started = time.time()
+    send_batches(con, 1, make_due=False)
+
+    attempts, next_attempt, sent_at, failed, error = notification(con, '502')
+    assert (attempts, sent_at, failed) == (1, None, 0)
+    assert error.startswith('502')
+    assert next_attempt - started >= notifications.RETRY_BASE * 0.8
+
+
+def test_flood_control_retry_after(con):
+    add_notification(con, '429')
+    add_notification(con, '1')
+    started = time.time()
+    stub, results = send_batches(con, 1, make_due=False)
+
+    # the whole bot pauses for retry_after and the message waits at least as long
+    assert results == [(2, 7)]
+    attempts, next_attempt, sent_at, failed, error = notification(con, '429')
+    assert (attempts, sent_at, failed) == (1, None, 0)
+    assert error.startswith('429')
+    assert next_attempt - started >= 7
+    assert notification(con, '1')[2] is not None
+
+    with con:
+        con.execute("UPDATE notifications SET next_attempt=0 WHERE sent_at IS NULL")
+    stub, results = send_batches(con, 1, stub=stub)
+    assert stub.calls == ['429', '1', '429']
+    assert notification(con, '429')[2] is not None
+
+
+def test_give_up_rejected(con):
+    add_notification(con, '403')
+    stub, results = send_batches(con, 2)
+
+    # rejected by Telegram: not retried
+    assert stub.calls == ['403']
+    assert results == [(1, 0), (0, 0)]
+    attempts, _, sent_at, failed, error = notification(con, '403')
+    assert (attempts, sent_at, failed) == (1, None, 1)
+    assert 'blocked' in error
+    assert con.execute("SELECT notification_sent FROM jobs WHERE job_token='token_403'").fetchone() == (0,)
+
+
+def test_give_up_max_attempts(con, monkeypatch):
+    monkeypatch.setattr(notifications, 'MAX_ATTEMPTS', 4)
+    add_notification(con, 'down')
+    stub, results = send_batches(con, 6)
+
+    assert stub.calls == ['down'] * 4
+    attempts, _, sent_at, failed, error = notification(con, 'down')
+    assert (attempts, sent_at, failed) == (4, None, 1)
+    assert error.startswith('502')
+
+
+def test_max_attempts_span():
+    # retries of an unavailable API span about a day before the notification is given up
+    total = sum(min(notifications.RETRY_BASE * 2 ** (attempts - 1), notifications.RETRY_MAX)
+                for attempts in range(1, notifications.MAX_ATTEMPTS))
+    assert 20 * 3600 <= total <= 28 * 3600
@@ -0,0 +1,66 @@
+'''
+Tests of the Rau low counts filter against a plain loop port of the .NET filter.
+'''
+
+import numpy as np
+import pandas as pd
+
+import Main
+import PyRauLCF
+
+
+def reference_threshold(matrix, vector, min, max, count):
+    # FindOptimalThreshold of the .NET filter: the Jaccard indexes of all replicate pairs are summed over all
+    # groups (EvaluateMean), an empty union gives NaN, and a threshold is taken only if its mean is above the best
+    best, best_threshold = 0., 0.
+    vector = np.asarray(vector)
+    for threshold in np.linspace(min, max, count):
+        expressed = matrix >= threshold
+        total, n_pairs = 0., 0
+        for group in np.unique(vector):
+            rows = np.flatnonzero(vector == group)
+            for i in range(len(rows)):
+                for j in range(i + 1, len(rows)):
+                    a, b = expressed[rows[i]], expressed[rows[j]]
+                    union = np.sum(a | b)
+                    total += np.sum(a & b) / union if union else np.nan
+                    n_pairs += 1
+        mean = total / n_pairs if n_pairs else np.nan
+        if mean > best:
+            best, best_threshold = mean, threshold
+    return best_threshold
+
+
+def test_matches_reference_unequal_groups():
+    for seed in range(10):
+        rng = np.random.default_rng(seed)
+        vector = np.array(['a'] * 2 + ['b'] * 8 + ['c'] * 3 + ['d'])
+        # noisy low counts, mid and high counts, the large group is shallower than the others
+        means = np.concatenate([rng.uniform(0.2, 3, 60), rng.uniform(5, 40, 40), rng.uniform(100, 400, 20)])
+        depth = np.where(vector == 'b', rng.uniform(0.3, 1), rng.uniform(1, 3))[:, None]
+        matrix = rng.poisson(means * depth * rng.gamma(4, 0.25, (len(vector), 120))).astype('float32')
+        assert PyRauLCF.FindOptimalThreshold(matrix, vector, 1, 200, 25) == \
+            reference_threshold(matrix, vector, 1, 200, 25)
+
+
+def test_threshold_counts_are_expressed():
+    # counts equal to a threshold are expressed: the shared counts of 1 make threshold 1 better than 2
+    matrix = np.array([[1, 2, 3], [1, 0, 3], [1, 2, 3], [1, 0, 3]], dtype='float32')
+    vector = ['a', 'a', 'b', 'b']
+    assert PyRauLCF.FindOptimalThreshold(matrix, vector, 1, 2, 2) == 1.
+
+
+def test_all_low_counts():
+    rng = np.random.default_rng(0)
+    matrix = rng.uniform(0, 0.9, (12, 50)).astype('float32')
+    vector = ['a'] * 6 + ['b'] * 6
+    assert PyRauLCF.FindOptimalThreshold(matrix, vector, 1, 200, 25) == 0.
+
+    data = pd.DataFrame(matrix, columns=[f'g{i}' for i in range(50)])
+    data['condition'] = [0] * 6 + [1] * 6
+    assert Main.RauLCF(data, 'condition').shape == (12, 51)
+
+
+def test_single_sample_conditions():
+    matrix = np.arange(12, dtype='float32').reshape(3, 4)
+    assert PyRauLCF.FindOptimalThreshold(matrix, ['a', 'b', 'c'], 1, 200, 25) == 0.
@@ -1,9 +1,17 @@
+import asyncio
 import telebot
+import time
 import toml
 import os
-import re
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
 from requests import ReadTimeout
+from redis import Redis
+from redis.exceptions import RedisError
+
+import job_store
+from job_events import publish_confirmed
+from progress import job_status
 
 try:
     config = toml.load('config.toml').get('tg')
@@ -16,20 +24,22 @@ except FileNotFoundError:
 
 path = f'{os.path.abspath(os.curdir)}/'
 
-bot = telebot.TeleBot(token=bot_token)
+MODE = config.get('mode') or 'polling'  # 'polling' or 'webhook'
+WORKERS = config.get('workers') or 8  # updates handled at once
+WEBHOOK_PATH = '/tg/webhook'
+RESTART_DELAY = 1  # seconds before the first restart after an error, doubled up to MAX_RESTART_DELAY
+MAX_RESTART_DELAY = 60
 
+if config.get('api_url'):  # e.g. a local Bot API server
+    telebot.apihelper.API_URL = f"{config['api_url'].rstrip('/')}/bot{{0}}/{{1}}"
 
-# Telegram bots have a limit of 4096 symbols per message, but I don't think this should cause any problems here,
-# thus standard bot.send_message(chat_id, text, **kwargs) will do.
+# In webhook mode updates are handled in the executor of the webhook server, not in telebot's own threads
+bot = telebot.TeleBot(token=bot_token, threaded=MODE != 'webhook', num_threads=WORKERS)
+redis_conn = Redis(host='localhost', port=6379, db=0)
 
 
-def add_escape_chars(input_str) -> str:
-    """
-    Copied from telebot.formatiing.escape_markdown
-    """
-    parse = re.sub(r"([_*\[\]()~`>\#\+\-=|\.!\{\}])", r"\\\1", input_str)
-    reparse = re.sub(r"\\\\([_*\[\]()~`>\#\+\-=|\.!\{\}])", r"\1", parse)
-    return reparse
+# Telegram bots have a limit of 4096 symbols per message, but I don't think this should cause any problems here,
+# thus standard bot.send_message(chat_id, text, **kwargs) will do.
 
 
 @bot.message_handler(commands=['help'])
@@ -43,19 +53,14 @@ def send_welcome(message):
     if _token and _token != '/start':  # if '/start' command contains an auth code
         # received token
         _token = _token.split()[-1]  # '/start tokenstr' -> tokenstr
-        with sqlite3.connect(f"{path}tg/jobs.db") as con:
-            cur = con.cursor()
-            cur.execute("SELECT user_filename FROM jobs WHERE job_token=?", (_token,))
-            filename = cur.fetchone()
-
-            if filename:
-                cur.execute("UPDATE jobs SET job_confirmed=1, user_id=? WHERE job_token=?", (message.chat.id, _token,))
-                con.commit()
-                bot.send_message(message.chat.id, f'{filename[0]} was added to job queue.\nYou will receive '
-                                                  f'a notification when the calculations are finished.')
-            else:
-                bot.send_message(message.chat.id, f'Oops! Something went wrong during user authentication.'
-                                                  f'\nPlease try again by returning to the website.')
+        filename = job_store.confirm_job(_token, message.chat.id)
+        if filename is not None:
+            publish_confirmed(_token)
+            bot.send_message(message.chat.id, f'{filename} was added to job queue.\nYou will receive '
+                                              f'a notification when the calculations are finished.')
+        else:
+            bot.send_message(message.chat.id, f'Oops! Something went wrong during user authentication.'
+                                              f'\nPlease try again by returning to the website.')
 
     else:  # just a /start command
         bot.send_message(message.chat.id, f'Hi! This bot helps you track jobs at the Koshmarkers website.'
@@ -65,34 +70,106 @@ def send_welcome(message):
                                           f'or by using the /help command (TODO).')
 
 
-def send_notification(user_id, filename, job_token):
-    bot.send_message(user_id,
-                     f'Calculations on {add_escape_chars(filename)} are complete\!'
-                     f'\nYou can now check the results by following the '
-                     f'[link](http://127.0.0.1:8070/?token={job_token})',
-                     parse_mode='MarkdownV2')
+@bot.message_handler(commands=['status'])
+def send_status(message):
+    jobs = job_store.user_jobs(message.chat.id)
+
+    if not jobs:
+        bot.send_message(message.chat.id, 'You have no running jobs.')
+        return
+
+    lines = []
+    for filename, job_token, start_time in jobs:
+        status = 'waiting in the queue'
+        if start_time is not None:
+            try:
+                status = job_status(job_token, redis_conn) or 'running'
+            except RedisError:
+                status = 'running'
+        lines.append(f'{filename}: {status}')
+    bot.send_message(message.chat.id, '\n'.join(lines))
+
+
+def notify_admin(text):
+    try:
+        bot.send_message(admin_chat, text)
+    except Exception:  # сообщение об ошибке может быть и не доставлено
+        pass
+
 
-    return 0
+def webhook_app(secret_token=None):
+    """
+    Webhook server: updates are handled by WORKERS threads at once, further requests wait for a free one,
+    so Telegram gets no more than WORKERS updates in flight (see max_connections in run_webhook)
+    :param str secret_token: value of X-Telegram-Bot-Api-Secret-Token set with the webhook
+    :return: aiohttp application
+    """
+    executor = ThreadPoolExecutor(max_workers=WORKERS)
+    semaphore = asyncio.Semaphore(WORKERS)
+
+    async def handle_update(request):
+        if secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return web.Response(status=403)
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+        except ValueError:
+            return web.Response(status=400)
+
+        async with semaphore:
+            try:
+                await asyncio.get_running_loop().run_in_executor(executor, bot.process_new_updates, [update])
+            except Exception as e:  # not retried by Telegram, the next updates would wait for it
+                print(f'Update {update.update_id} failed: {e}')
+        return web.Response()
+
+    async def shutdown(app):
+        executor.shutdown(wait=True)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+def run_webhook():
+    """
+    Register the webhook and serve updates until the process is stopped
+    :return:
+    """
+    secret_token = config.get('webhook_secret') or None
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{config['webhook_url'].rstrip('/')}{WEBHOOK_PATH}", secret_token=secret_token,
+                    max_connections=WORKERS)
+    web.run_app(webhook_app(secret_token), host=config.get('webhook_host') or '0.0.0.0',
+                port=config.get('webhook_port') or 8443, print=None)
 
 
-def main(after_crash=False):
+def main():
     """
-    bot.polling() wrapper for error notifications
-    :param bool after_crash:
+    Runs the bot in polling or webhook mode and restarts it after errors, with a growing delay if it keeps failing
     :return:
     """
-    try:
-        text_addition = '' if not after_crash else ' после ошибки.'  # сообщение об ошибке может быть и не доставлено
-        bot.send_message(admin_chat, f'Бот активирован{text_addition}')
-        bot.polling(non_stop=True)
-    except ReadTimeout:
-        pass
-    except ConnectionError:
-        pass
-    except Exception as e:
-        bot.send_message(admin_chat, f'Ошибка телеграм-бота: {str(e)}')
-    finally:
-        main(after_crash=True)  # не в except, т.к. send_message тоже может вызвать exception
+    notify_admin('Бот активирован')
+    delay = RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        try:
+            if MODE == 'webhook':
+                run_webhook()
+            else:
+                bot.remove_webhook()  # Telegram doesn't send updates to getUpdates while a webhook is set
+                bot.polling(non_stop=True)
+            return  # stopped, e.g. with Ctrl+C
+        except (ReadTimeout, ConnectionError):
+            pass
+        except Exception as e:
+            notify_admin(f'Ошибка телеграм-бота: {str(e)}')
+
+        if time.monotonic() - started > MAX_RESTART_DELAY:  # worked for a while, a new error
+            delay = RESTART_DELAY
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_RESTART_DELAY)
+        notify_admin('Бот активирован после ошибки.')
 
 
 def launch_bot():